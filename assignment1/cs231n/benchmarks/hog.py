@@ -0,0 +1,88 @@
+"""
+Benchmark the HOG feature kernels on synthetic CIFAR-shaped images.
+
+hog_feature (the reference), hog_feature_integral and hog_features_batch are
+timed on the same images, and every output is compared with the reference,
+so a run reports both speed and agreement. Half of the images are quantized
+to a few intensity levels, which produces the flat regions and exact
+gradient ties where the float32 kernel has to match the reference's
+binning. Example:
+
+    python -m cs231n.benchmarks.hog --num-images 1000 --output hog.json
+"""
+from __future__ import print_function
+
+import argparse
+
+import numpy as np
+
+from cs231n.benchmarks.utils import measure, write_results
+from cs231n.features import hog_feature, hog_feature_integral, hog_features_batch
+
+KERNELS = ('hog_feature', 'hog_feature_integral', 'hog_features_batch')
+
+
+def make_images(num_images, height=32, width=32, seed=0):
+    """
+    Random uint8 RGB images; the first half is quantized to four levels.
+    """
+    rng = np.random.RandomState(seed)
+    imgs = rng.randint(0, 256, (num_images, height, width, 3)).astype(np.uint8)
+    imgs[:num_images // 2] = imgs[:num_images // 2] // 64 * 64
+    return imgs
+
+
+def run(num_images=1000, kernels=KERNELS, repeats=3, seed=0):
+    """
+    Time every kernel on one set of images and compare it with hog_feature.
+
+    Returns a list of records with the kernel, seconds per image, the
+    largest absolute difference from hog_feature, that difference relative
+    to the largest reference feature, and whether the output matches the
+    reference to single precision.
+    """
+    imgs = make_images(num_images, seed=seed)
+    fns = {
+        'hog_feature': lambda: np.array([hog_feature(im) for im in imgs]),
+        'hog_feature_integral': lambda: np.array([hog_feature_integral(im)
+                                                  for im in imgs]),
+        'hog_features_batch': lambda: hog_features_batch(imgs),
+    }
+    reference = fns['hog_feature']()
+    scale = np.max(np.abs(reference))
+
+    results = []
+    for name in kernels:
+        stats = measure(fns[name], repeats=repeats)
+        diff = np.abs(stats['result'] - reference)
+        results.append({
+            'kernel': name, 'num_images': num_images,
+            'seconds': stats['seconds'],
+            'seconds_per_image': stats['seconds'] / num_images,
+            'peak_bytes': stats['peak_bytes'],
+            'max_abs_diff': float(diff.max()),
+            'rel_diff': float(diff.max() / scale),
+            'matches': bool(np.allclose(stats['result'], reference,
+                                        rtol=1e-4, atol=1e-4)),
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--num-images', type=int, default=1000)
+    parser.add_argument('--kernel', nargs='+', default=list(KERNELS),
+                        choices=KERNELS)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write; defaults to stdout')
+    args = parser.parse_args(argv)
+
+    results = run(args.num_images, kernels=args.kernel, repeats=args.repeats,
+                  seed=args.seed)
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
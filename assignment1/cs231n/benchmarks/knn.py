@@ -0,0 +1,133 @@
+"""
+Benchmark the KNearestNeighbor distance implementations and predict paths
+on synthetic CIFAR-shaped data, so no dataset download is needed.
+
+Every combination of num_train, num_test, D and storage dtype is timed for
+each method, and the results are written as JSON so that runs of different
+releases can be compared. Example:
+
+    python -m cs231n.benchmarks.knn --num-train 5000 50000 --num-test 500 \
+        --dim 3072 --dtype float64 float32 --output knn.json
+"""
+from __future__ import print_function
+
+import argparse
+
+import numpy as np
+
+from cs231n.benchmarks.utils import measure, write_results
+from cs231n.classifiers.k_nearest_neighbor import KNearestNeighbor
+
+METHODS = ('two_loops', 'one_loop', 'no_loops', 'predict_labels',
+           'predict_chunked')
+
+
+def make_data(num_train, num_test, dim, num_classes=10, seed=0):
+    """
+    Random mean-subtracted pixel data in the range of CIFAR-10 images.
+    """
+    rng = np.random.RandomState(seed)
+    X_train = rng.uniform(0, 255, (num_train, dim)) - 127.5
+    X_test = rng.uniform(0, 255, (num_test, dim)) - 127.5
+    y_train = rng.randint(num_classes, size=num_train)
+    return X_train, y_train, X_test
+
+
+def bench_case(method, knn, X_test, k, repeats):
+    """
+    Benchmark one method on a trained classifier.
+    """
+    if method == 'two_loops':
+        fn = lambda: knn.compute_distances_two_loops(X_test)
+    elif method == 'one_loop':
+        fn = lambda: knn.compute_distances_one_loop(X_test)
+    elif method == 'no_loops':
+        fn = lambda: knn.compute_distances_no_loops(X_test)
+    elif method == 'predict_labels':
+        dists = knn.compute_distances_no_loops(X_test)
+        fn = lambda: knn.predict_labels(dists, k=k)
+    elif method == 'predict_chunked':
+        fn = lambda: knn.predict_chunked(X_test, k=k)
+    else:
+        raise ValueError('Unrecognized method "%s"' % method)
+    stats = measure(fn, repeats=repeats)
+    del stats['result']
+    return stats
+
+
+def run(num_trains, num_tests, dims, dtypes, methods=METHODS, k=5,
+        repeats=3, max_loop_pairs=10 ** 7, seed=0, verbose=False):
+    """
+    Sweep the benchmark grid.
+
+    Inputs:
+    - num_trains, num_tests, dims: Sequences of sizes to sweep.
+    - dtypes: Sequence of storage dtypes: 'float64' (the training data as
+      given), 'float32' or 'int8'.
+    - methods: Subset of METHODS to run.
+    - k: Number of neighbors for the predict methods.
+    - repeats: Number of timed repetitions per case.
+    - max_loop_pairs: The loop-based methods are skipped when num_train *
+      num_test exceeds this, as they would take hours.
+    - seed: Seed of the synthetic data.
+    - verbose: Print every result as it is measured.
+
+    Returns a list of dictionaries, one per case, with the case parameters
+    and the measured seconds, peak_bytes, queries_per_sec and
+    distances_per_sec.
+    """
+    results = []
+    for num_train in num_trains:
+        for num_test in num_tests:
+            for dim in dims:
+                X_train, y_train, X_test = make_data(num_train, num_test, dim,
+                                                     seed=seed)
+                for dtype in dtypes:
+                    knn = KNearestNeighbor()
+                    knn.train(X_train, y_train,
+                              dtype=None if dtype == 'float64' else dtype)
+                    for method in methods:
+                        if (method in ('two_loops', 'one_loop') and
+                                num_train * num_test > max_loop_pairs):
+                            continue
+                        record = {'method': method, 'num_train': num_train,
+                                  'num_test': num_test, 'dim': dim,
+                                  'dtype': dtype, 'k': k}
+                        record.update(bench_case(method, knn, X_test, k, repeats))
+                        record['queries_per_sec'] = num_test / record['seconds']
+                        record['distances_per_sec'] = (
+                            num_test * num_train / record['seconds'])
+                        if verbose:
+                            print('%(method)s train=%(num_train)d test=%(num_test)d '
+                                  'D=%(dim)d %(dtype)s: %(seconds).4f s, '
+                                  'peak %(peak_bytes)d bytes' % record)
+                        results.append(record)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--num-train', type=int, nargs='+', default=[5000])
+    parser.add_argument('--num-test', type=int, nargs='+', default=[500])
+    parser.add_argument('--dim', type=int, nargs='+', default=[3072])
+    parser.add_argument('--dtype', nargs='+', default=['float64'],
+                        choices=['float64', 'float32', 'int8'])
+    parser.add_argument('--method', nargs='+', default=list(METHODS),
+                        choices=METHODS)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max-loop-pairs', type=int, default=10 ** 7)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write; defaults to stdout')
+    args = parser.parse_args(argv)
+
+    results = run(args.num_train, args.num_test, args.dim, args.dtype,
+                  methods=args.method, k=args.k, repeats=args.repeats,
+                  max_loop_pairs=args.max_loop_pairs, seed=args.seed,
+                  verbose=args.output is not None)
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
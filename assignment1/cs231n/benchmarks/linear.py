@@ -0,0 +1,214 @@
+"""
+Benchmarks for the linear classifier losses and solvers on synthetic
+CIFAR-shaped data.
+
+Subcommands:
+- svm-loss: time and per-step allocations of svm_loss_vectorized against
+  svm_loss_fused with a reused workspace, in float64 and float32.
+- svm-solvers: training time and final training loss of LinearSVM with
+  minibatch SGD (train), full-batch L-BFGS (train_lbfgs) and dual coordinate
+  descent (train_dual) on the same data.
+- threads: time of one loss and gradient evaluation on a large batch with
+  sharded_loss over 1, 2, 4, ... threads, for both losses. Set
+  OPENBLAS_NUM_THREADS=1 (or MKL_NUM_THREADS / OMP_NUM_THREADS) to measure
+  the thread pool alone rather than on top of a multithreaded BLAS.
+
+Example:
+
+    python -m cs231n.benchmarks.linear svm-loss --batch-size 200 --output svm.json
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from cs231n.benchmarks.utils import allocated_bytes, measure, write_results
+from cs231n.classifiers.linear_classifier import LinearSVM, sharded_loss
+from cs231n.classifiers.softmax import softmax_loss_vectorized
+from cs231n.classifiers.linear_svm import (SVMWorkspace, svm_loss_fused,
+                                           svm_loss_vectorized)
+
+
+def make_data(num_train, dim, num_classes=10, seed=0):
+    """
+    Random linearly separable-ish data with a bias column, shaped like the
+    preprocessed CIFAR-10 rows used in the svm and softmax notebooks.
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(num_classes, dim - 1)
+    y = rng.randint(num_classes, size=num_train)
+    X = centers[y] + 4 * rng.randn(num_train, dim - 1)
+    X = np.hstack([X, np.ones((num_train, 1))])
+    return X, y
+
+
+def bench_svm_loss(batch_size=200, dim=3073, num_classes=10, reg=2.5e4,
+                   repeats=20, seed=0):
+    """
+    Compare svm_loss_vectorized and svm_loss_fused on one minibatch.
+
+    Returns a list of records with the implementation, dtype, seconds per
+    step and allocated_bytes per step.
+    """
+    X, y = make_data(batch_size, dim, num_classes, seed)
+    W = 0.001 * np.random.RandomState(seed).randn(dim, num_classes)
+    results = []
+    for dtype in (np.float64, np.float32):
+        X_d, W_d = X.astype(dtype), W.astype(dtype)
+        workspace = SVMWorkspace(batch_size, dim, num_classes, dtype)
+        fns = {
+            'vectorized': lambda: svm_loss_vectorized(W_d, X_d, y, reg),
+            'fused': lambda: svm_loss_fused(W_d, X_d, y, reg, workspace),
+        }
+        for name, fn in sorted(fns.items()):
+            stats = measure(fn, repeats=repeats)
+            results.append({
+                'benchmark': 'svm-loss', 'implementation': name,
+                'dtype': np.dtype(dtype).name, 'batch_size': batch_size,
+                'dim': dim, 'num_classes': num_classes,
+                'seconds': stats['seconds'],
+                'allocated_bytes': allocated_bytes(fn),
+            })
+    return results
+
+
+def bench_svm_solvers(num_train=10000, dim=3073, num_classes=10, reg=1e-2,
+                      sgd_iters=1500, learning_rate=1e-1, batch_size=200,
+                      lbfgs_iters=100, max_passes=20, seed=0):
+    """
+    Train LinearSVM on one dataset with each solver from W = 0.
+
+    Returns a list of records with the solver, its training time in seconds,
+    the final svm_loss_vectorized loss on the training data, the training
+    accuracy and the number of iterations or passes used.
+    """
+    X, y = make_data(num_train, dim, num_classes, seed)
+    X /= np.sqrt(dim)
+
+    def run_sgd(model):
+        model.train(X, y, learning_rate=learning_rate, reg=reg,
+                    num_iters=sgd_iters, batch_size=batch_size)
+        return sgd_iters
+
+    def run_lbfgs(model):
+        model.train_lbfgs(X, y, reg=reg, max_iters=lbfgs_iters)
+        return model.lbfgs_info['num_iters']
+
+    def run_dual(model):
+        model.train_dual(X, y, reg=reg, max_passes=max_passes, seed=seed)
+        return model.dual_info['num_passes']
+
+    results = []
+    for name, fn in [('sgd', run_sgd), ('lbfgs', run_lbfgs),
+                     ('dual', run_dual)]:
+        np.random.seed(seed)
+        model = LinearSVM()
+        model.W = np.zeros((dim, num_classes))
+        start = time.time()
+        iterations = fn(model)
+        seconds = time.time() - start
+        results.append({
+            'benchmark': 'svm-solvers', 'solver': name,
+            'num_train': num_train, 'dim': dim, 'num_classes': num_classes,
+            'reg': reg, 'seconds': seconds, 'iterations': iterations,
+            'loss': float(svm_loss_vectorized(model.W, X, y, reg)[0]),
+            'accuracy': float(np.mean(model.predict(X) == y)),
+        })
+    return results
+
+
+def bench_threads(batch_size=20000, dim=3073, num_classes=10, reg=1e-3,
+                  thread_counts=None, repeats=5, seed=0):
+    """
+    Time svm_loss_fused and softmax_loss_vectorized on one large batch,
+    split over each number of threads in thread_counts with sharded_loss.
+    thread_counts defaults to the powers of two up to the number of CPUs.
+
+    Returns a list of records with the loss, thread count, seconds per
+    evaluation and speedup over a single thread.
+    """
+    if thread_counts is None:
+        thread_counts = [1]
+        while thread_counts[-1] * 2 <= os.cpu_count():
+            thread_counts.append(thread_counts[-1] * 2)
+    X, y = make_data(batch_size, dim, num_classes, seed)
+    W = 0.001 * np.random.RandomState(seed).randn(dim, num_classes)
+
+    results = []
+    for name, loss_function in [('svm', svm_loss_fused),
+                                ('softmax', softmax_loss_vectorized)]:
+        baseline = None
+        for num_threads in thread_counts:
+            with ThreadPoolExecutor(num_threads) as executor:
+                fn = lambda: sharded_loss(loss_function, W, X, y, reg,
+                                          executor, num_threads)
+                seconds = measure(fn, repeats=repeats)['seconds']
+            if baseline is None:
+                baseline = seconds
+            results.append({
+                'benchmark': 'threads', 'loss': name,
+                'num_threads': num_threads, 'batch_size': batch_size,
+                'dim': dim, 'num_classes': num_classes, 'seconds': seconds,
+                'speedup': baseline / seconds,
+            })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    svm_loss = subparsers.add_parser('svm-loss')
+    svm_loss.add_argument('--batch-size', type=int, default=200)
+    svm_loss.add_argument('--dim', type=int, default=3073)
+    svm_loss.add_argument('--num-classes', type=int, default=10)
+    svm_loss.add_argument('--repeats', type=int, default=20)
+
+    svm_solvers = subparsers.add_parser('svm-solvers')
+    svm_solvers.add_argument('--num-train', type=int, default=10000)
+    svm_solvers.add_argument('--dim', type=int, default=3073)
+    svm_solvers.add_argument('--num-classes', type=int, default=10)
+    svm_solvers.add_argument('--reg', type=float, default=1e-2)
+    svm_solvers.add_argument('--sgd-iters', type=int, default=1500)
+    svm_solvers.add_argument('--learning-rate', type=float, default=1e-1)
+    svm_solvers.add_argument('--batch-size', type=int, default=200)
+    svm_solvers.add_argument('--lbfgs-iters', type=int, default=100)
+    svm_solvers.add_argument('--max-passes', type=int, default=20)
+
+    threads = subparsers.add_parser('threads')
+    threads.add_argument('--batch-size', type=int, default=20000)
+    threads.add_argument('--dim', type=int, default=3073)
+    threads.add_argument('--num-classes', type=int, default=10)
+    threads.add_argument('--threads', type=int, nargs='+', default=None,
+                         help='thread counts; defaults to powers of two up '
+                              'to the number of CPUs')
+    threads.add_argument('--repeats', type=int, default=5)
+
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write; defaults to stdout')
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'svm-loss':
+        results = bench_svm_loss(args.batch_size, args.dim, args.num_classes,
+                                 repeats=args.repeats, seed=args.seed)
+    elif args.benchmark == 'svm-solvers':
+        results = bench_svm_solvers(args.num_train, args.dim, args.num_classes,
+                                    args.reg, args.sgd_iters,
+                                    args.learning_rate, args.batch_size,
+                                    args.lbfgs_iters, args.max_passes,
+                                    seed=args.seed)
+    elif args.benchmark == 'threads':
+        results = bench_threads(args.batch_size, args.dim, args.num_classes,
+                                thread_counts=args.threads,
+                                repeats=args.repeats, seed=args.seed)
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
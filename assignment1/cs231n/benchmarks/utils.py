@@ -0,0 +1,85 @@
+from __future__ import print_function
+
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def measure(fn, repeats=3):
+    """
+    Time a function and trace its memory use.
+
+    Inputs:
+    - fn: Function of no arguments to benchmark.
+    - repeats: Number of timed calls; the fastest one is reported.
+
+    Returns a dictionary with:
+    - seconds: Best wall-clock time over the repeats.
+    - peak_bytes: Peak memory allocated during one traced call, as seen by
+      tracemalloc (which includes numpy array buffers).
+    - result: Return value of the last call.
+    """
+    tracemalloc.start()
+    try:
+        result = fn()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    best = float('inf')
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - tic)
+    return {'seconds': best, 'peak_bytes': peak_bytes, 'result': result}
+
+
+def allocated_bytes(fn, warmup=1):
+    """
+    Measure the memory that one call of fn allocates on top of what is
+    already allocated, as the tracemalloc peak during the call minus the
+    traced memory before it. Warm-up calls run first so that one-time
+    allocations, such as lazily created buffers, are not counted.
+    """
+    for _ in range(warmup):
+        fn()
+    tracemalloc.start()
+    try:
+        fn()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        fn()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+
+def environment_info():
+    """
+    Describe the machine and library versions, to store next to results.
+    """
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'system': platform.system(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def write_results(results, output=None):
+    """
+    Dump benchmark records as JSON, together with environment_info, to the
+    file output or to stdout if it is None.
+    """
+    report = {'environment': environment_info(), 'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
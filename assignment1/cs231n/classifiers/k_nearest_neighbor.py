@@ -1,29 +1,258 @@
 from builtins import range
 from builtins import object
+import multiprocessing
+import os
+import time
+import warnings
+from multiprocessing import shared_memory
+
 import numpy as np
 from past.builtins import xrange
+from cs231n.classifiers.knn_index import (IVFIndex, PQIndex, KDTree,
+                                          GrowableArray, dot_transposed,
+                                          l1_distances, smallest_k, merge_smallest_k,
+                                          squared_distances, squared_norms)
+
+# Default number of bytes predict_chunked may spend on distance tiles.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 ** 2
+
+
+def _share_array(arr):
+    """
+    Copy arr into a new shared memory block.
+
+    Returns a tuple of the SharedMemory object, which the caller must close
+    and unlink, and a picklable (name, shape, dtype) spec to attach to it.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+# Per-process state of the prediction workers started by
+# KNearestNeighbor.predict(..., n_jobs > 1).
+_worker_blocks = []
+_worker_knn = None
+
+
+def _init_predict_worker(X_spec, sum_spec, y_spec, num_classes, storage_dtype,
+                         train_scale):
+    """
+    Pool initializer: attach to the shared training data and wrap it in a
+    classifier without copying it.
+    """
+    global _worker_knn
+    arrays = []
+    for name, shape, dtype in (X_spec, sum_spec, y_spec):
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_blocks.append(shm)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    _worker_knn = KNearestNeighbor()
+    _worker_knn.X_train, _worker_knn.train_data_sum, _worker_knn.y_train = arrays
+    _worker_knn.num_classes = num_classes
+    _worker_knn.storage_dtype = storage_dtype
+    _worker_knn.train_scale = train_scale
+    _worker_knn.index = None
+
+
+def _predict_shard(args):
+    X, k, num_loops, memory_budget = args
+    return _worker_knn.predict(X, k=k, num_loops=num_loops,
+                               memory_budget=memory_budget)
+
 
 class KNearestNeighbor(object):
     """ a kNN classifier with L2 distance """
 
     def __init__(self):
-        pass
+        # (n_jobs, pool, shared memory blocks) of the workers started by
+        # predict(..., n_jobs > 1), kept until the training data changes.
+        self._workers = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker pool started by predict(..., n_jobs > 1) and free its
+        shared copy of the training data. train, add and load_index call this
+        since they change the data; a later parallel predict starts a new pool.
+        """
+        workers, self._workers = getattr(self, '_workers', None), None
+        if workers is None:
+            return
+        _, pool, blocks = workers
+        pool.terminate()
+        pool.join()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
 
-    def train(self, X, y):
+    def train(self, X, y, index=None, dtype=None, keep_data=False,
+              **index_params):
         """
         Train the classifier. For k-nearest neighbors this is just
-        memorizing the training data.
+        memorizing the training data and caching its squared norms, optionally
+        followed by building an index for approximate search.
 
         Inputs:
         - X: A numpy array of shape (num_train, D) containing the training data
           consisting of num_train samples each of dimension D.
         - y: A numpy array of shape (N,) containing the training labels, where
              y[i] is the label for X[i].
+        - dtype: Storage type of the training data. None keeps a reference to
+          X as given. 'float32' stores a single precision copy, and 'int8'
+          stores X / train_scale rounded to int8 with a single scale chosen so
+          that the largest magnitude maps to 127. In both cases test data is
+          converted to float32 and distances are computed in single precision.
+        - index: None for exact brute-force search, 'ivf' to cluster the
+          training data into an IVFIndex, 'pq' to compress it into a PQIndex,
+          or 'kdtree' to build an exact KDTree for low-dimensional data (a
+          warning is issued above KDTree.MAX_USEFUL_DIM dimensions).
+          predict then searches the index instead of X.
+        - index_params: Keyword arguments for the index constructor, e.g.
+          nlist and nprobe for 'ivf', m and nbits for 'pq', or leaf_size and
+          metric ('l2' or 'l1') for 'kdtree'.
+        - keep_data: With index='pq', keep the uncompressed training data and
+          its squared norms next to the codes. By default they are dropped
+          once the index is built, as after load_index, since the PQ search
+          only reads the codes; keep them to use measure_recall or the
+          brute-force distance methods.
         """
-        self.X_train = X
+        self.close()
+        self.storage_dtype = None if dtype is None else np.dtype(dtype)
+        self.train_scale = None
+        if self.storage_dtype == np.int8:
+            max_abs = float(np.max(np.abs(X))) if X.size else 0.0
+            self.train_scale = max_abs / 127 if max_abs > 0 else 1.0
+        elif self.storage_dtype not in (None, np.float32):
+            raise ValueError('Unsupported storage dtype "%s"' % dtype)
+        self.X_train = self._encode_train(X)
         self.y_train = y
+        self.num_classes = int(np.max(y)) + 1
+        # Squared norms of the stored training points, reused by every
+        # distance computation.
+        self.train_data_sum = squared_norms(self.X_train)
+        # Growable copies of the three arrays above, created by add.
+        self._stores = None
+
+        if index is None:
+            self.index = None
+        elif index == 'ivf':
+            self.index = IVFIndex(**index_params)
+            self.index.build(self.X_train)
+        elif index == 'kdtree':
+            if X.shape[1] > KDTree.MAX_USEFUL_DIM:
+                warnings.warn('A KDTree over %d dimensions is unlikely to beat '
+                              'brute-force search; it pays off up to about %d.'
+                              % (X.shape[1], KDTree.MAX_USEFUL_DIM), stacklevel=2)
+            self.index = KDTree(**index_params)
+            self.index.build(self.X_train)
+        elif index == 'pq':
+            if self.storage_dtype is not None:
+                raise ValueError('index="pq" compresses the data itself and '
+                                 'does not support a storage dtype')
+            self.index = PQIndex(**index_params)
+            self.index.build(X)
+            if not keep_data:
+                self.X_train = None
+                self.train_data_sum = None
+        else:
+            raise ValueError('Unrecognized index "%s"' % index)
+
+    def add(self, X, y):
+        """
+        Add labelled points to the training data of a trained classifier.
+
+        On the first call the training data, labels and squared norms are
+        copied into GrowableArray buffers, so this and later calls append in
+        amortized constant time per point rather than re-concatenating the
+        whole training set. An index, if any, is updated incrementally. With
+        int8 storage the new points reuse the scale chosen by train and are
+        clipped to its range. With a PQIndex only the codes and labels grow;
+        uncompressed data kept with keep_data=True is released, as it would
+        no longer match the index. On a classifier that was never trained,
+        the first call is train(X, y), so a model can be built up by add alone.
+
+        Inputs:
+        - X: A numpy array of shape (num_new, D) of new training points.
+        - y: A numpy array of shape (num_new,) of their labels.
+
+        Returns:
+        - elapsed: Wall-clock time of the insert, in seconds.
+        """
+        tic = time.time()
+        if getattr(self, 'y_train', None) is None:
+            self.train(X, y)
+            return time.time() - tic
+        self.close()
+        X = self._encode_train(X)
+        if isinstance(self.index, PQIndex):
+            self.X_train = None
+            self.train_data_sum = None
+        if self._stores is None:
+            arrays = (self.X_train, self.y_train, self.train_data_sum)
+            self._stores = [None if arr is None else GrowableArray(arr)
+                            for arr in arrays]
+        X_store, y_store, sum_store = self._stores
+        y_store.append(y)
+        self.y_train = y_store.array
+        self.num_classes = max(self.num_classes, int(np.max(y)) + 1)
+        if X_store is not None:
+            X_store.append(X)
+            sum_store.append(squared_norms(X))
+            self.X_train = X_store.array
+            self.train_data_sum = sum_store.array
+        if self.index is not None:
+            self.index.add(X, self.X_train)
+        return time.time() - tic
+
+    def memory_usage(self):
+        """
+        Report the memory held by the classifier.
+
+        Returns a dictionary mapping 'X_train', 'y_train', 'train_data_sum' and
+        'index' to their size in bytes. Buffers grown by add are counted with
+        their full capacity.
+        """
+        names = ('X_train', 'y_train', 'train_data_sum')
+        if self._stores is not None:
+            usage = {name: 0 if store is None else store.nbytes
+                     for name, store in zip(names, self._stores)}
+        else:
+            usage = {name: 0 if getattr(self, name) is None
+                     else np.asarray(getattr(self, name)).nbytes
+                     for name in names}
+        usage['index'] = 0 if self.index is None else self.index.nbytes
+        return usage
+
+    def save_index(self, filename):
+        """
+        Save the product-quantized index and the training labels to a flat
+        binary file; see PQIndex.save for the layout.
+        """
+        if not isinstance(self.index, PQIndex):
+            raise ValueError('save_index requires a classifier trained with index="pq"')
+        self.index.save(filename, labels=self.y_train)
 
-    def predict(self, X, k=1, num_loops=0):
+    def load_index(self, filename):
+        """
+        Restore a classifier saved with save_index. Only the compressed codes
+        are loaded, so afterwards predictions always go through the index and
+        the brute-force distance methods are unavailable.
+        """
+        self.close()
+        self.index, self.y_train = PQIndex.load(filename)
+        if self.y_train is None:
+            raise ValueError('%s holds no training labels' % filename)
+        self.X_train = None
+        self.num_classes = int(np.max(self.y_train)) + 1
+        self.storage_dtype = None
+        self.train_scale = None
+        self.train_data_sum = None
+        self._stores = None
+
+    def predict(self, X, k=1, num_loops=0, memory_budget=None, n_jobs=None):
         """
         Predict labels for test data using this classifier.
 
@@ -33,11 +262,44 @@ class KNearestNeighbor(object):
         - k: The number of nearest neighbors that vote for the predicted labels.
         - num_loops: Determines which implementation to use to compute distances
           between training points and testing points.
+        - memory_budget: If not None, the number of bytes that may be spent on
+          distances at any one time. The distances are then computed tile by
+          tile with predict_chunked instead of as one (num_test, num_train)
+          matrix. Only supported with num_loops=0.
+        - n_jobs: If greater than 1, split the test points across this many
+          worker processes (-1 uses one per CPU). The training data, its
+          squared norms and the labels are copied into shared memory and the
+          pool is started on the first such call; later calls with the same
+          n_jobs reuse both until the training data changes or close is
+          called. Every worker runs the selected distance implementation on
+          its shard. Not supported with an index.
+
+        If the classifier was trained with an index, the neighbors are looked up
+        in the index and num_loops and memory_budget are ignored.
 
         Returns:
         - y: A numpy array of shape (num_test,) containing predicted labels for the
           test data, where y[i] is the predicted label for the test point X[i].
         """
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        parallel = n_jobs is not None and n_jobs > 1
+
+        if self.index is not None:
+            if parallel:
+                raise ValueError('n_jobs is not supported with an index')
+            _, top_idx = self.index.search(self._to_storage_space(X), k,
+                                           self.X_train, self.train_data_sum)
+            return self._vote(top_idx).astype(np.float64)
+
+        if parallel:
+            return self._predict_parallel(X, k, num_loops, memory_budget, n_jobs)
+
+        if memory_budget is not None:
+            if num_loops != 0:
+                raise ValueError('memory_budget requires num_loops=0')
+            return self.predict_chunked(X, k=k, memory_budget=memory_budget)
+
         if num_loops == 0:
             dists = self.compute_distances_no_loops(X)
         elif num_loops == 1:
@@ -49,6 +311,289 @@ class KNearestNeighbor(object):
 
         return self.predict_labels(dists, k=k)
 
+    def _predict_parallel(self, X, k, num_loops, memory_budget, n_jobs):
+        """
+        Run predict over shards of X in a pool of n_jobs processes that
+        attach to the training data through shared memory.
+        """
+        if num_loops == 0 and memory_budget is not None:
+            # Each worker gets its share of the budget.
+            memory_budget = memory_budget // n_jobs
+        shards = [(X_shard, k, num_loops, memory_budget)
+                  for X_shard in np.array_split(X, n_jobs) if len(X_shard)]
+        y_pred = self._worker_pool(n_jobs).map(_predict_shard, shards)
+        return np.concatenate(y_pred) if y_pred else np.zeros(0)
+
+    def _worker_pool(self, n_jobs):
+        """
+        Return a pool of n_jobs prediction workers attached to a shared copy
+        of the training data, starting it unless one is already running.
+        """
+        if self._workers is not None and self._workers[0] == n_jobs:
+            return self._workers[1]
+        self.close()
+        blocks = []
+        try:
+            specs = []
+            for arr in (self.X_train, self.train_data_sum, self.y_train):
+                shm, spec = _share_array(np.asarray(arr))
+                blocks.append(shm)
+                specs.append(spec)
+            pool = multiprocessing.Pool(n_jobs, initializer=_init_predict_worker,
+                                        initargs=tuple(specs) + (
+                                            self.num_classes, self.storage_dtype,
+                                            self.train_scale))
+        except Exception:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+            raise
+        self._workers = (n_jobs, pool, blocks)
+        return pool
+
+    def _encode_train(self, X):
+        """
+        Convert training points to the storage dtype chosen in train.
+        """
+        if self.storage_dtype is None:
+            return X
+        if self.storage_dtype == np.float32:
+            return X.astype(np.float32)
+        return np.clip(np.rint(X / self.train_scale), -127, 127).astype(np.int8)
+
+    def _to_storage_space(self, X):
+        """
+        Convert test data to the precision and scale of the stored training
+        data, so that distances to the stored points can be computed directly.
+        """
+        if self.storage_dtype is None:
+            return X
+        X = X.astype(np.float32)
+        if self.train_scale is not None:
+            X /= self.train_scale
+        return X
+
+    def _from_storage_space(self, dists):
+        """
+        Undo the scaling of int8 storage on squared distances, in place.
+        """
+        if self.train_scale is not None:
+            dists *= self.train_scale ** 2
+        return dists
+
+    def predict_chunked(self, X, k=1, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Predict labels for test data without materializing the full distance
+        matrix.
+
+        The distances are computed with the same expansion as
+        compute_distances_no_loops, but one (test rows, train columns) tile at
+        a time. Each tile is reduced to its k nearest neighbors right away and
+        merged into the running candidates of its test rows, so once a block of
+        test rows has seen every training column it can be voted on and its
+        tiles discarded. Tiles span all training columns whenever the budget
+        allows it; otherwise the training set is split into column blocks too.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: The number of nearest neighbors that vote for the predicted labels.
+        - memory_budget: Approximate upper bound, in bytes, on the memory used
+          by one distance tile and its partition indices.
+
+        Returns:
+        - y: A numpy array of shape (num_test,) containing predicted labels.
+        """
+        y_pred = np.zeros(X.shape[0])
+        for start, stop, _, top_idx in self._iter_neighbors(X, k, memory_budget):
+            y_pred[start:stop] = self._vote(top_idx)
+        return y_pred
+
+    def _iter_neighbors(self, X, k, memory_budget):
+        """
+        Generator behind predict_chunked: yields (start, stop, top_dists,
+        top_idx) with the k nearest training points of X[start:stop] for
+        consecutive blocks of test rows. The distances are squared and in
+        storage space, and the neighbors come in no particular order.
+        """
+        num_test = X.shape[0]
+        num_train = self.X_train.shape[0]
+        test_chunk, train_chunk = self._tile_shape(num_test, num_train, k,
+                                                   memory_budget)
+        cast_bytes = self._cast_bytes(memory_budget)
+
+        X = self._to_storage_space(X)
+        test_data_sum = squared_norms(X)
+        train_data_sum = self.train_data_sum
+        for start in range(0, num_test, test_chunk):
+            stop = min(start + test_chunk, num_test)
+            top_dists, top_idx = None, None
+            for col in range(0, num_train, train_chunk):
+                col_stop = min(col + train_chunk, num_train)
+                tile = squared_distances(X[start:stop],
+                                         self.X_train[col:col_stop],
+                                         X_sum=test_data_sum[start:stop],
+                                         Y_sum=train_data_sum[col:col_stop],
+                                         cast_bytes=cast_bytes)
+                dists, idx = smallest_k(tile, k)
+                idx += col
+                del tile
+                if top_dists is None:
+                    top_dists, top_idx = dists, idx
+                else:
+                    top_dists, top_idx = merge_smallest_k(top_dists, top_idx,
+                                                          dists, idx, k)
+            yield start, stop, top_dists, top_idx
+
+    def cross_validate(self, X, y, k_choices, num_folds=5, dtype=None,
+                       memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Estimate the accuracy of every k in k_choices with num_folds-fold
+        cross-validation.
+
+        Every fold computes its block of distances once, in tiles bounded by
+        memory_budget, and keeps only the max(k_choices) nearest neighbors of
+        each held-out point, sorted by distance. The votes for all values of k
+        are then read off cumulative label counts along that sorted list, so
+        the cost hardly depends on the number of k values tried. This
+        classifier's own training data is left untouched.
+
+        Inputs:
+        - X: A numpy array of shape (N, D) of data to split into folds.
+        - y: A numpy array of shape (N,) of labels.
+        - k_choices: Sequence of positive values of k to evaluate.
+        - num_folds: Number of folds, split as with np.array_split; between 2
+          and N so that no fold is empty.
+        - dtype: Storage dtype used for the training part of every fold; see
+          train.
+        - memory_budget: Bytes that may be spent on one distance tile.
+
+        Returns:
+        - accuracies: Array of shape (num_folds, len(k_choices)) where
+          accuracies[i, j] is the validation accuracy on fold i with
+          k = k_choices[j].
+        """
+        if not 2 <= num_folds <= X.shape[0]:
+            raise ValueError('num_folds must be between 2 and the number of '
+                             'points (%d), got %d' % (X.shape[0], num_folds))
+        k_choices = np.asarray(k_choices, dtype=np.int64)
+        max_k = int(np.max(k_choices))
+        num_classes = int(np.max(y)) + 1
+        folds = np.array_split(np.arange(X.shape[0]), num_folds)
+        accuracies = np.zeros((num_folds, len(k_choices)))
+        for i, val_idx in enumerate(folds):
+            train_idx = np.concatenate(folds[:i] + folds[i + 1:])
+            knn = KNearestNeighbor()
+            knn.train(X[train_idx], y[train_idx], dtype=dtype)
+            k = min(max_k, train_idx.size)
+            # k larger than the training part of a fold votes with all of it.
+            ks = np.minimum(k_choices, k)
+
+            num_correct = np.zeros(len(k_choices))
+            for start, stop, top_dists, top_idx in knn._iter_neighbors(
+                    X[val_idx], k, memory_budget):
+                order = np.argsort(top_dists, axis=1, kind='stable')
+                closest_y = knn.y_train[np.take_along_axis(top_idx, order, axis=1)]
+                # counts[r, j, c] is the number of votes for label c among the
+                # j + 1 nearest neighbors of validation point r.
+                counts = np.cumsum(np.eye(num_classes, dtype=np.int32)[closest_y],
+                                   axis=1)
+                y_pred = np.argmax(counts[:, ks - 1, :], axis=2)
+                num_correct += np.sum(y_pred == y[val_idx[start:stop], None],
+                                      axis=0)
+            accuracies[i] = num_correct / val_idx.size
+
+        return accuracies
+
+    def measure_recall(self, X, k=1, nprobe=None):
+        """
+        Measure how well the index recovers the exact nearest neighbors.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) of queries.
+        - k: Number of neighbors to compare.
+        - nprobe: Number of inverted lists to probe; defaults to the index
+          setting. Raising it increases both recall and query time.
+
+        Returns:
+        - recall: The fraction of the exact k nearest neighbors that the
+          index search returned. The exact neighbors are found by brute force
+          in the metric of the index: compute_distances_no_loops for L2, or
+          l1_distances for a KDTree with metric='l1'.
+        """
+        if self.index is None:
+            raise ValueError('measure_recall requires a classifier trained with an index')
+        if self.X_train is None:
+            raise ValueError('measure_recall needs the uncompressed training data; '
+                             'train with keep_data=True')
+        metric = getattr(self.index, 'metric', 'l2')
+        if metric == 'l2':
+            exact = self.compute_distances_no_loops(X)
+        elif metric == 'l1':
+            exact = l1_distances(self._to_storage_space(X), self.X_train)
+        else:
+            raise ValueError('measure_recall does not support metric "%s"' % metric)
+        _, exact_idx = smallest_k(exact, k)
+        _, approx_idx = self.index.search(self._to_storage_space(X), k,
+                                          self.X_train, self.train_data_sum,
+                                          nprobe=nprobe)
+        hits = (approx_idx[:, :, None] == exact_idx[:, None, :]).any(axis=2)
+        return np.sum(hits) / float(exact_idx.size)
+
+    def _tile_shape(self, num_test, num_train, k, memory_budget):
+        """
+        Choose the (rows, columns) shape of the distance tiles used by
+        predict_chunked so that a tile plus its argpartition indices fit in
+        memory_budget bytes, next to the float32 conversion of int8 training
+        blocks (see _cast_bytes).
+        """
+        memory_budget = int(memory_budget) - 2 * self._cast_bytes(memory_budget)
+        # Each tile entry costs one float64 distance and one int64 index.
+        max_entries = max(1, memory_budget // 16)
+        if max_entries >= num_train:
+            return max(1, min(num_test, max_entries // num_train)), num_train
+        # Not even a single full row fits: tile the training columns as well,
+        # but keep tiles wide enough to hold k candidates per row.
+        train_chunk = max(k, max_entries)
+        test_chunk = max(1, min(num_test, max_entries // train_chunk))
+        return test_chunk, train_chunk
+
+    def _cast_bytes(self, memory_budget):
+        """
+        Bytes that squared_distances may spend on each of its two temporaries
+        when multiplying int8 training storage in float32: the converted
+        block of training rows and its block of products. An eighth of the
+        budget each; nothing for floating point storage.
+        """
+        if self.storage_dtype == np.int8:
+            return int(memory_budget) // 8
+        return 0
+
+    def _vote(self, top_idx):
+        """
+        Majority vote among the k nearest neighbors of a block of test points.
+        Ties are broken by choosing the smaller label.
+
+        Inputs:
+        - top_idx: Array of shape (num_rows, k) of training indices. Entries
+          equal to -1 mark missing neighbors and do not vote.
+
+        Returns:
+        - y: Array of shape (num_rows,) of predicted labels.
+        """
+        num_slots = self.num_classes + 1
+        closest_y = np.where(top_idx >= 0, self.y_train[top_idx],
+                             self.num_classes)
+        num_rows = closest_y.shape[0]
+        # Count the votes of all rows with a single bincount by shifting the
+        # labels of row i into the slots [i * num_slots, (i + 1) * num_slots);
+        # the last slot of every row collects the missing neighbors.
+        offsets = np.arange(num_rows)[:, None] * num_slots
+        counts = np.bincount((closest_y + offsets).ravel(),
+                             minlength=num_rows * num_slots)
+        counts = counts.reshape(num_rows, num_slots)[:, :-1]
+        # argmax returns the first maximum, i.e. the smallest tied label.
+        return np.argmax(counts, axis=1)
+
     def compute_distances_two_loops(self, X):
         """
         Compute the distance between each test point in X and each training point
@@ -63,6 +608,7 @@ class KNearestNeighbor(object):
           is the Euclidean distance between the ith test point and the jth training
           point.
         """
+        X = self._to_storage_space(X)
         num_test = X.shape[0]
         num_train = self.X_train.shape[0]
         dists = np.zeros((num_test, num_train))
@@ -77,7 +623,7 @@ class KNearestNeighbor(object):
                 # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
                 dists[i,j] = np.sum((X[i,:] - self.X_train[j,:])**2)
                 # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-        return dists
+        return self._from_storage_space(dists)
 
     def compute_distances_one_loop(self, X):
         """
@@ -86,6 +632,7 @@ class KNearestNeighbor(object):
 
         Input / Output: Same as compute_distances_two_loops
         """
+        X = self._to_storage_space(X)
         num_test = X.shape[0]
         num_train = self.X_train.shape[0]
         dists = np.zeros((num_test, num_train))
@@ -101,7 +648,7 @@ class KNearestNeighbor(object):
             dists[i, :] = np.sum((X[i, :] - self.X_train)**2, axis=1)
 
             # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-        return dists
+        return self._from_storage_space(dists)
 
     def compute_distances_no_loops(self, X):
         """
@@ -110,6 +657,7 @@ class KNearestNeighbor(object):
 
         Input / Output: Same as compute_distances_two_loops
         """
+        X = self._to_storage_space(X)
         num_test = X.shape[0]
         num_train = self.X_train.shape[0]
         dists = np.zeros((num_test, num_train))
@@ -129,16 +677,12 @@ class KNearestNeighbor(object):
         # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
         # (A - B) ^ 2 = A^2 - 2AB + B^2
         test_data_sum = np.sum(X ** 2, axis=1) # num_test x 1
-        print("test data sum shape", test_data_sum.shape)
-        train_data_sum = np.sum(self.X_train ** 2, axis=1) # num_train x 1
-        print("train data sum shape", train_data_sum.shape)
-        inner_product = np.dot(X, self.X_train.T) # num_test x num_train
-        print("inner product shape", inner_product.shape)
-        dists = -2 * inner_product + test_data_sum.reshape(-1, 1) + train_data_sum 
-        print("dists shape", dists.shape)
-        
+        train_data_sum = self.train_data_sum # num_train x 1
+        inner_product = dot_transposed(X, self.X_train) # num_test x num_train
+        dists = -2 * inner_product + test_data_sum.reshape(-1, 1) + train_data_sum
+
         # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-        return dists
+        return self._from_storage_space(dists)
 
     def predict_labels(self, dists, k=1):
         """
@@ -155,29 +699,18 @@ class KNearestNeighbor(object):
         """
         num_test = dists.shape[0]
         y_pred = np.zeros(num_test)
-        for i in range(num_test):
-            # A list of length k storing the labels of the k nearest neighbors to
-            # the ith test point.
-            closest_y = []
-            #########################################################################
-            # TODO:                                                                 #
-            # Use the distance matrix to find the k nearest neighbors of the ith    #
-            # testing point, and use self.y_train to find the labels of these       #
-            # neighbors. Store these labels in closest_y.                           #
-            # Hint: Look up the function numpy.argsort.                             #
-            #########################################################################
-            # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-            closest_y = self.y_train[dists[i, :].argsort()[:k]]
-            # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-            #########################################################################
-            # TODO:                                                                 #
-            # Now that you have found the labels of the k nearest neighbors, you    #
-            # need to find the most common label in the list closest_y of labels.   #
-            # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-            # label.                                                                #
-            #########################################################################
-            # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
-            y_pred[i] = np.argmax(np.bincount(closest_y))
-            # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
+        #########################################################################
+        # TODO:                                                                 #
+        # Use the distance matrix to find the k nearest neighbors of each       #
+        # testing point, and use self.y_train to find the labels of these       #
+        # neighbors. Then find the most common label among them and store it    #
+        # in y_pred. Break ties by choosing the smaller label.                  #
+        #########################################################################
+        # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
+        # argpartition selects the k nearest neighbors of every row in linear
+        # time; their order does not matter for the vote.
+        _, top_idx = smallest_k(dists, k)
+        y_pred[:] = self._vote(top_idx)
+        # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
         return y_pred
@@ -0,0 +1,755 @@
+from builtins import range
+from builtins import object
+import numpy as np
+
+
+class GrowableArray(object):
+    """
+    Array that grows along its first axis with amortized constant-time
+    appends: rows are written into a preallocated buffer whose capacity
+    doubles whenever it runs full, so n appended rows cost O(n) copies in
+    total instead of one full concatenation per append.
+    """
+
+    def __init__(self, data):
+        """
+        Inputs:
+        - data: Initial contents; copied into a buffer of the same size.
+        """
+        data = np.asarray(data)
+        self._buffer = data.copy()
+        self.size = data.shape[0]
+
+    @property
+    def array(self):
+        """ View of the filled part of the buffer. """
+        return self._buffer[:self.size]
+
+    @property
+    def nbytes(self):
+        """ Bytes allocated for the buffer, including unused capacity. """
+        return self._buffer.nbytes
+
+    def append(self, rows):
+        """
+        Append rows, an array whose shape matches the buffer except along the
+        first axis.
+        """
+        rows = np.asarray(rows)
+        needed = self.size + rows.shape[0]
+        if needed > self._buffer.shape[0]:
+            capacity = max(needed, 2 * self._buffer.shape[0], 16)
+            buffer = np.empty((capacity,) + self._buffer.shape[1:],
+                              dtype=self._buffer.dtype)
+            buffer[:self.size] = self._buffer[:self.size]
+            self._buffer = buffer
+        self._buffer[self.size:needed] = rows
+        self.size = needed
+
+
+def smallest_k(dists, k):
+    """
+    Find the k smallest entries in every row of a distance matrix.
+
+    Inputs:
+    - dists: A numpy array of shape (num_rows, num_cols).
+    - k: Number of entries to keep per row.
+
+    Returns a tuple of:
+    - top_dists: Array of shape (num_rows, min(k, num_cols)) with the selected
+      distances, in no particular order.
+    - top_idx: Integer array of the same shape giving the columns of dists
+      that the selected distances came from.
+    """
+    num_rows, num_cols = dists.shape
+    if k >= num_cols:
+        top_idx = np.broadcast_to(np.arange(num_cols), dists.shape).copy()
+        return dists.copy(), top_idx
+    top_idx = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(dists, top_idx, axis=1), top_idx
+
+
+def merge_smallest_k(dists_a, idx_a, dists_b, idx_b, k):
+    """
+    Merge two candidate sets produced by smallest_k into a single set holding
+    the k smallest distances of their union, row by row.
+    """
+    dists = np.concatenate((dists_a, dists_b), axis=1)
+    idx = np.concatenate((idx_a, idx_b), axis=1)
+    top_dists, pos = smallest_k(dists, k)
+    return top_dists, np.take_along_axis(idx, pos, axis=1)
+
+
+# Default bound, in bytes, on the float32 copies that dot_transposed makes of
+# integer data such as int8 training storage.
+CAST_BLOCK_BYTES = 4 * 1024 ** 2
+
+
+def squared_norms(X):
+    """
+    Squared L2 norms of the rows of X, accumulated in float64 without
+    allocating a squared copy of X. Integer inputs are safe from overflow.
+    """
+    return np.einsum('ij,ij->i', X, X, dtype=np.float64)
+
+
+def dot_transposed(X, Y, cast_bytes=CAST_BLOCK_BYTES):
+    """
+    Compute X.dot(Y.T) for X of shape (N, D) and Y of shape (M, D).
+
+    Integer X, a block of queries or points chosen by the caller, is
+    converted as a whole. Integer Y, typically int8 training storage, is
+    converted to float32 a block of rows at a time, so that neither the
+    converted block nor its block of products exceeds cast_bytes.
+    """
+    if X.dtype.kind in 'iu':
+        X = X.astype(np.result_type(Y.dtype, np.float32))
+    if Y.dtype.kind not in 'iu':
+        return np.dot(X, Y.T)
+    num_rows, num_cols = X.shape[0], Y.shape[0]
+    block = max(1, int(cast_bytes) // (4 * max(Y.shape[1], num_rows, 1)))
+    if block >= num_cols:
+        return np.dot(X, Y.astype(np.float32).T)
+    out = np.empty((num_rows, num_cols), dtype=np.result_type(X.dtype, np.float32))
+    for start in range(0, num_cols, block):
+        out[:, start:start + block] = np.dot(
+            X, Y[start:start + block].astype(np.float32).T)
+    return out
+
+
+def squared_distances(X, Y, X_sum=None, Y_sum=None, cast_bytes=CAST_BLOCK_BYTES):
+    """
+    Squared L2 distances between the rows of X and the rows of Y, computed as
+    |x|^2 - 2 x.y + |y|^2 with a single matrix multiplication.
+
+    Inputs:
+    - X: Array of shape (N, D).
+    - Y: Array of shape (M, D).
+    - X_sum, Y_sum: Optional precomputed squared norms of the rows of X and Y.
+    - cast_bytes: Bound on the temporary float32 copies of integer Y; see
+      dot_transposed.
+
+    Integer inputs, such as int8 training storage, are multiplied in float32.
+
+    Returns:
+    - dists: Array of shape (N, M).
+    """
+    if X_sum is None:
+        X_sum = squared_norms(X)
+    if Y_sum is None:
+        Y_sum = squared_norms(Y)
+    dists = dot_transposed(X, Y, cast_bytes)
+    dists *= -2
+    dists += X_sum[:, None]
+    dists += Y_sum
+    return dists
+
+
+def l1_distances(X, Y, block_bytes=16 * 1024 ** 2):
+    """
+    L1 distances between the rows of X and the rows of Y.
+
+    The differences are broadcast over blocks of rows of X and Y sized so
+    that the (rows, cols, D) difference array stays under block_bytes.
+
+    Returns an array of shape (N, M).
+    """
+    num_rows, num_cols, dim = X.shape[0], Y.shape[0], X.shape[1]
+    dists = np.empty((num_rows, num_cols))
+    cols = max(1, min(num_cols, block_bytes // (8 * max(dim, 1))))
+    rows = max(1, block_bytes // (8 * max(dim, 1) * cols))
+    for start in range(0, num_rows, rows):
+        for col in range(0, num_cols, cols):
+            diff = X[start:start + rows, None, :] - Y[None, col:col + cols, :]
+            dists[start:start + rows, col:col + cols] = np.sum(np.abs(diff), axis=2)
+    return dists
+
+
+def nearest_centroid(X, centroids, block_size=4096):
+    """
+    Assign every row of X to its closest centroid, processing X in blocks so
+    that the (N, num_centroids) distance matrix is never held in full.
+
+    Returns an integer array of shape (N,).
+    """
+    centroid_sum = squared_norms(centroids)
+    assign = np.empty(X.shape[0], dtype=np.int64)
+    for start in range(0, X.shape[0], block_size):
+        dists = squared_distances(X[start:start + block_size], centroids,
+                                  Y_sum=centroid_sum)
+        assign[start:start + block_size] = np.argmin(dists, axis=1)
+    return assign
+
+
+def centroid_sums(X, assign, num_clusters, block_bytes=8 * 1024 ** 2):
+    """
+    Sum the rows of X that belong to each cluster.
+
+    Every block of rows is reduced with one matrix product between a one-hot
+    (num_clusters, rows) membership matrix and the block, which BLAS handles
+    far faster than the scattered np.add.at. Blocks are sized so that their
+    float64 conversion stays under block_bytes.
+
+    Returns an array of shape (num_clusters, D).
+    """
+    num_points, dim = X.shape
+    sums = np.zeros((num_clusters, dim))
+    block_size = max(1, block_bytes // (8 * max(dim, 1)))
+    for start in range(0, num_points, block_size):
+        block = assign[start:start + block_size]
+        onehot = np.zeros((num_clusters, block.size))
+        onehot[block, np.arange(block.size)] = 1
+        sums += onehot.dot(X[start:start + block_size])
+    return sums
+
+
+def kmeans(X, num_clusters, num_iters=10, seed=0):
+    """
+    Cluster the rows of X with Lloyd's algorithm.
+
+    Inputs:
+    - X: Array of shape (N, D).
+    - num_clusters: Number of centroids; must not exceed N.
+    - num_iters: Number of assignment / update rounds.
+    - seed: Seed of the random initialization.
+
+    Returns a tuple of:
+    - centroids: Array of shape (num_clusters, D).
+    - assign: Array of shape (N,) giving the centroid of every row of X.
+    """
+    rng = np.random.RandomState(seed)
+    num_points = X.shape[0]
+    centroids = X[rng.choice(num_points, num_clusters, replace=False)]
+    centroids = centroids.astype(np.float64)
+    assign = nearest_centroid(X, centroids)
+    for it in range(num_iters):
+        counts = np.bincount(assign, minlength=num_clusters)
+        sums = centroid_sums(X, assign, num_clusters)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed clusters that lost all their points with random rows.
+        if np.any(empty):
+            centroids[empty] = X[rng.choice(num_points, np.sum(empty))]
+        assign = nearest_centroid(X, centroids)
+    return centroids, assign
+
+
+class IVFIndex(object):
+    """
+    Inverted-file index for approximate L2 nearest neighbor search.
+
+    The training points are clustered with k-means (the coarse quantizer) and
+    stored as one inverted list of point ids per cluster. A query is only
+    compared against the points of the nprobe lists whose centroids are
+    closest to it, so nprobe trades recall for speed: nprobe = nlist gives
+    exact search, small values visit a fraction nprobe / nlist of the data.
+
+    Every list is a GrowableArray of point ids, so that new points can be
+    added without rebuilding the index; the centroids stay fixed.
+    """
+
+    def __init__(self, nlist=100, nprobe=8, num_iters=10, seed=0):
+        """
+        Inputs:
+        - nlist: Number of k-means clusters / inverted lists.
+        - nprobe: Default number of lists visited per query.
+        - num_iters: Number of k-means iterations used to build the index.
+        - seed: Seed of the k-means initialization.
+        """
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.num_iters = num_iters
+        self.seed = seed
+
+    def build(self, X):
+        """
+        Cluster X and fill the inverted lists with the ids of its rows.
+
+        Inputs:
+        - X: A numpy array of shape (num_train, D).
+        """
+        nlist = min(self.nlist, X.shape[0])
+        self.centroids, assign = kmeans(X, nlist, self.num_iters, self.seed)
+        counts = np.bincount(assign, minlength=nlist)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        order = np.argsort(assign, kind='stable')
+        self.lists = [GrowableArray(order[offsets[l]:offsets[l + 1]])
+                      for l in range(nlist)]
+
+    def add(self, X, data):
+        """
+        Add the last X.shape[0] rows of data, which are equal to X, to the
+        inverted lists of their nearest centroids.
+        """
+        assign = nearest_centroid(X, self.centroids)
+        ids = np.arange(data.shape[0] - X.shape[0], data.shape[0])
+        for l in np.unique(assign):
+            self.lists[l].append(ids[assign == l])
+
+    @property
+    def nbytes(self):
+        return self.centroids.nbytes + sum(ids.nbytes for ids in self.lists)
+
+    def search(self, X, k, data, data_sum=None, nprobe=None):
+        """
+        Find approximate k nearest neighbors of the rows of X.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) of queries.
+        - k: Number of neighbors to return per query.
+        - data: The (num_train, D) array the index was built on.
+        - data_sum: Optional precomputed squared norms of the rows of data.
+        - nprobe: Number of lists to visit per query; defaults to self.nprobe.
+
+        Returns a tuple of:
+        - top_dists: Array of shape (num_test, k) of squared L2 distances.
+        - top_idx: Array of shape (num_test, k) of row indices into data.
+          Queries whose probed lists hold fewer than k points are padded with
+          distance inf and index -1.
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        num_test = X.shape[0]
+        test_sum = squared_norms(X)
+        top_dists = np.full((num_test, k), np.inf)
+        top_idx = np.full((num_test, k), -1, dtype=np.int64)
+
+        coarse = squared_distances(X, self.centroids, X_sum=test_sum)
+        _, probes = smallest_k(coarse, nprobe)
+
+        # Group the (query, list) pairs by list so that each inverted list is
+        # scanned once, with one matrix multiplication for all its queries.
+        rows = np.repeat(np.arange(num_test), probes.shape[1])
+        lists = probes.ravel()
+        order = np.argsort(lists, kind='stable')
+        rows, lists = rows[order], lists[order]
+        bounds = np.flatnonzero(np.diff(lists)) + 1
+        for group in np.split(np.arange(rows.size), bounds):
+            if group.size == 0:
+                continue
+            l = lists[group[0]]
+            ids = self.lists[l].array
+            if ids.size == 0:
+                continue
+            q = rows[group]
+            ids_sum = None if data_sum is None else data_sum[ids]
+            dists = squared_distances(X[q], data[ids], X_sum=test_sum[q],
+                                      Y_sum=ids_sum)
+            dists, pos = smallest_k(dists, k)
+            top_dists[q], top_idx[q] = merge_smallest_k(
+                top_dists[q], top_idx[q], dists, ids[pos], k)
+        return top_dists, top_idx
+
+
+class PQIndex(object):
+    """
+    Product-quantized store for approximate L2 nearest neighbor search.
+
+    The D dimensions are split into m contiguous subspaces and every subspace
+    gets its own k-means codebook of 2 ** nbits centroids, so a training point
+    is stored as m uint8 codes instead of D floats. Queries are not quantized:
+    search builds, for every query, a table of squared distances from each of
+    its sub-vectors to each sub-centroid, and the distance to a stored point
+    is the sum of m table lookups (asymmetric distance computation).
+    """
+
+    MAGIC = b'PQIX'
+    VERSION = 1
+
+    def __init__(self, m=8, nbits=8, num_iters=10, seed=0):
+        """
+        Inputs:
+        - m: Number of subspaces, i.e. bytes per encoded point.
+        - nbits: Bits per code; at most 8 so that codes fit in a uint8.
+        - num_iters: Number of k-means iterations per codebook.
+        - seed: Seed of the k-means initialization.
+        """
+        if not 1 <= nbits <= 8:
+            raise ValueError('nbits must be between 1 and 8')
+        self.m = m
+        self.nbits = nbits
+        self.num_iters = num_iters
+        self.seed = seed
+
+    def build(self, X):
+        """
+        Learn one codebook per subspace from X and encode X with them.
+
+        Inputs:
+        - X: A numpy array of shape (num_train, D) with D >= m.
+        """
+        dim = X.shape[1]
+        ksub = min(2 ** self.nbits, X.shape[0])
+        self.bounds = np.linspace(0, dim, self.m + 1).astype(np.int64)
+        self.codebooks = []
+        for j in range(self.m):
+            sub = X[:, self.bounds[j]:self.bounds[j + 1]]
+            centroids, _ = kmeans(sub, ksub, self.num_iters, self.seed + j)
+            self.codebooks.append(centroids.astype(np.float32))
+        self._codes = GrowableArray(self.encode(X))
+
+    @property
+    def codes(self):
+        """ Array of shape (num_train, m) of uint8 codes of the stored points. """
+        return self._codes.array
+
+    def add(self, X, data=None):
+        """
+        Encode the rows of X and append them to the stored points. The
+        codebooks stay fixed.
+        """
+        self._codes.append(self.encode(X))
+
+    @property
+    def nbytes(self):
+        return (sum(codebook.nbytes for codebook in self.codebooks) +
+                self._codes.nbytes)
+
+    def encode(self, X):
+        """
+        Quantize the rows of X to an array of shape (N, m) of uint8 codes.
+        """
+        codes = np.empty((X.shape[0], self.m), dtype=np.uint8)
+        for j in range(self.m):
+            sub = X[:, self.bounds[j]:self.bounds[j + 1]]
+            codes[:, j] = nearest_centroid(sub, self.codebooks[j])
+        return codes
+
+    def decode(self, codes):
+        """
+        Reconstruct approximate vectors of shape (N, D) from their codes.
+        """
+        return np.hstack([self.codebooks[j][codes[:, j]]
+                          for j in range(self.m)])
+
+    def distance_tables(self, X):
+        """
+        Squared distances from every query sub-vector to every sub-centroid.
+
+        Returns an array of shape (num_test, m, ksub).
+        """
+        ksub = self.codebooks[0].shape[0]
+        tables = np.empty((X.shape[0], self.m, ksub), dtype=np.float32)
+        for j in range(self.m):
+            sub = X[:, self.bounds[j]:self.bounds[j + 1]]
+            tables[:, j, :] = squared_distances(sub, self.codebooks[j])
+        return tables
+
+    def search(self, X, k, data=None, data_sum=None, nprobe=None,
+               block_size=2 ** 22):
+        """
+        Find approximate k nearest neighbors of the rows of X among the
+        encoded points.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) of queries.
+        - k: Number of neighbors to return per query.
+        - data, data_sum, nprobe: Ignored; accepted so that PQIndex can be used
+          wherever an IVFIndex is.
+        - block_size: Number of (query, point) distances evaluated at a time.
+
+        Returns a tuple of:
+        - top_dists: Array of shape (num_test, min(k, num_train)) of
+          approximate squared L2 distances.
+        - top_idx: Array of the same shape of row indices of the neighbors.
+        """
+        num_test = X.shape[0]
+        num_train = self.codes.shape[0]
+        k = min(k, num_train)
+        test_chunk = max(1, block_size // max(num_train, 1))
+        top_dists = np.empty((num_test, k), dtype=np.float32)
+        top_idx = np.empty((num_test, k), dtype=np.int64)
+        for start in range(0, num_test, test_chunk):
+            tables = self.distance_tables(X[start:start + test_chunk])
+            dists = np.zeros((tables.shape[0], num_train), dtype=np.float32)
+            for j in range(self.m):
+                dists += tables[:, j, self.codes[:, j]]
+            top_dists[start:start + test_chunk], top_idx[start:start + test_chunk] = \
+                smallest_k(dists, k)
+        return top_dists, top_idx
+
+    def save(self, filename, labels=None):
+        """
+        Write the index to a flat binary file.
+
+        The layout is a fixed header of little-endian int64 values
+        (version, D, m, ksub, num_train, has_labels) after the 4-byte magic
+        string, followed by the m + 1 subspace bounds (int64), the codebooks
+        (float32, subspace after subspace), the codes (uint8, row major) and,
+        if given, the labels (int64).
+
+        Inputs:
+        - filename: Path of the file to write.
+        - labels: Optional array of shape (num_train,) of labels to store with
+          the codes, as needed to restore a classifier.
+        """
+        ksub = self.codebooks[0].shape[0]
+        header = np.array([self.VERSION, self.bounds[-1], self.m, ksub,
+                           self.codes.shape[0], labels is not None],
+                          dtype='<i8')
+        with open(filename, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(header.tobytes())
+            f.write(self.bounds.astype('<i8').tobytes())
+            for codebook in self.codebooks:
+                f.write(codebook.astype('<f4').tobytes())
+            f.write(np.ascontiguousarray(self.codes).tobytes())
+            if labels is not None:
+                f.write(np.asarray(labels).astype('<i8').tobytes())
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read an index written by save.
+
+        Returns a tuple of:
+        - index: The restored PQIndex.
+        - labels: The stored labels, or None if the file has none.
+        """
+        with open(filename, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError('%s is not a PQIndex file' % filename)
+            header = np.frombuffer(f.read(6 * 8), dtype='<i8')
+            version, dim, m, ksub, num_train, has_labels = [int(v) for v in header]
+            if version != cls.VERSION:
+                raise ValueError('Unsupported PQIndex version %d' % version)
+            index = cls(m=m, nbits=max(1, int(np.ceil(np.log2(ksub)))))
+            index.bounds = np.fromfile(f, dtype='<i8', count=m + 1).astype(np.int64)
+            index.codebooks = []
+            for j in range(m):
+                sub_dim = index.bounds[j + 1] - index.bounds[j]
+                codebook = np.fromfile(f, dtype='<f4', count=ksub * sub_dim)
+                index.codebooks.append(codebook.reshape(ksub, sub_dim).astype(np.float32))
+            codes = np.fromfile(f, dtype=np.uint8, count=num_train * m)
+            index._codes = GrowableArray(codes.reshape(num_train, m))
+            labels = None
+            if has_labels:
+                labels = np.fromfile(f, dtype='<i8', count=num_train)
+        return index, labels
+
+
+class KDTree(object):
+    """
+    KD-tree for exact nearest neighbor search in low dimensions.
+
+    The tree is stored in flat arrays indexed by node id instead of as node
+    objects: node i covers the training points order[start[i]:end[i]], has
+    the bounding box [lo[i], hi[i]] and, unless it is a leaf (left[i] == -1),
+    children left[i] and right[i] obtained by splitting its widest dimension
+    at the median.
+
+    Queries are answered in batches. Every query first scans the leaf it
+    falls into, which gives it a tight k-th best distance. The tree is then
+    traversed once for the whole batch: every node is visited at most once,
+    with the queries whose k-th best distance so far exceeds the distance to
+    the node's bounding box, and its children are visited nearer-first for
+    most of those queries. The Python work therefore grows with the number
+    of nodes visited, not with the number of queries.
+
+    Like any KD-tree it only pays off in low dimensions, where the bounding
+    boxes prune most of the tree. On 50k Gaussian points with the default
+    leaf_size it is several times faster than brute force up to about 8
+    dimensions, on par around 16 and slower beyond; for higher dimensional
+    data such as raw CIFAR-10 pixels use brute force or an IVFIndex.
+
+    Points added after the tree was built are kept in a pending list that
+    every search scans by brute force; once it exceeds rebuild_fraction of
+    the tree size the tree is rebuilt over all points.
+    """
+
+    # Dimensionality above which KNearestNeighbor.train warns that the tree
+    # is unlikely to beat brute-force search.
+    MAX_USEFUL_DIM = 16
+
+    def __init__(self, leaf_size=1024, metric='l2', rebuild_fraction=0.25):
+        """
+        Inputs:
+        - leaf_size: Maximum number of points in a leaf. Leaves are scanned with
+          one matrix multiplication per batch of queries, so leaves much larger
+          than in a classic KD-tree pay off by cutting the number of visited
+          nodes.
+        - metric: 'l2' for (squared) Euclidean or 'l1' for Manhattan distance.
+        - rebuild_fraction: Size of the pending list of added points, relative
+          to the number of points in the tree, that triggers a rebuild.
+        """
+        if metric not in ('l2', 'l1'):
+            raise ValueError('Unrecognized metric "%s"' % metric)
+        self.leaf_size = leaf_size
+        self.metric = metric
+        self.rebuild_fraction = rebuild_fraction
+
+    def build(self, X):
+        """
+        Build the tree over the rows of X.
+
+        Inputs:
+        - X: A numpy array of shape (num_train, D).
+        """
+        num_train, dim = X.shape
+        self.pending = GrowableArray(np.zeros(0, dtype=np.int64))
+        # Median splits leave at least leaf_size / 2 points in every leaf, which
+        # bounds the number of nodes.
+        max_nodes = 4 * (num_train // max(1, self.leaf_size)) + 3
+        self.order = np.arange(num_train)
+        self.start = np.zeros(max_nodes, dtype=np.int64)
+        self.end = np.zeros(max_nodes, dtype=np.int64)
+        self.left = np.full(max_nodes, -1, dtype=np.int64)
+        self.right = np.full(max_nodes, -1, dtype=np.int64)
+        self.split_dim = np.zeros(max_nodes, dtype=np.int64)
+        self.split_val = np.zeros(max_nodes)
+        self.lo = np.zeros((max_nodes, dim))
+        self.hi = np.zeros((max_nodes, dim))
+
+        self.end[0] = num_train
+        num_nodes = 1
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            start, end = self.start[node], self.end[node]
+            ids = self.order[start:end]
+            points = X[ids]
+            if end > start:
+                self.lo[node] = points.min(axis=0)
+                self.hi[node] = points.max(axis=0)
+            if end - start <= self.leaf_size:
+                continue
+            spread = self.hi[node] - self.lo[node]
+            dim_ = int(np.argmax(spread))
+            if spread[dim_] == 0:
+                continue
+            half = (end - start) // 2
+            part = np.argpartition(points[:, dim_], half)
+            self.order[start:end] = ids[part]
+            self.split_dim[node] = dim_
+            self.split_val[node] = points[part[half], dim_]
+
+            left, right = num_nodes, num_nodes + 1
+            num_nodes += 2
+            self.left[node], self.right[node] = left, right
+            self.start[left], self.end[left] = start, start + half
+            self.start[right], self.end[right] = start + half, end
+            stack.extend((left, right))
+
+        for name in ('start', 'end', 'left', 'right', 'split_dim', 'split_val',
+                     'lo', 'hi'):
+            setattr(self, name, getattr(self, name)[:num_nodes])
+
+    def add(self, X, data):
+        """
+        Register the last X.shape[0] rows of data, which are equal to X, as
+        pending points, and rebuild the tree over all of data once there are
+        too many of them.
+        """
+        self.pending.append(np.arange(data.shape[0] - X.shape[0], data.shape[0]))
+        if self.pending.size > self.rebuild_fraction * self.order.size:
+            self.build(data)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in
+                   ('order', 'start', 'end', 'left', 'right', 'split_dim',
+                    'split_val', 'lo', 'hi')) + self.pending.nbytes
+
+    def _box_distances(self, X, node):
+        """
+        Distances from the rows of X to the bounding box of node, in the
+        metric of the tree; zero for points inside the box.
+        """
+        gap = np.maximum(self.lo[node] - X, 0) + np.maximum(X - self.hi[node], 0)
+        if self.metric == 'l2':
+            return np.sum(gap ** 2, axis=1)
+        return np.sum(gap, axis=1)
+
+    def _point_distances(self, X, points, X_sum, points_sum):
+        if self.metric == 'l2':
+            dists = squared_distances(X, points, X_sum=X_sum, Y_sum=points_sum)
+            return np.maximum(dists, 0, out=dists)
+        return l1_distances(X, points)
+
+    def search(self, X, k, data, data_sum=None, nprobe=None):
+        """
+        Find the exact k nearest neighbors of the rows of X.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) of queries.
+        - k: Number of neighbors to return per query.
+        - data: The (num_train, D) array the tree was built on.
+        - data_sum: Optional precomputed squared norms of the rows of data.
+        - nprobe: Ignored; accepted so that KDTree can be used wherever an
+          IVFIndex is.
+
+        Returns a tuple of:
+        - top_dists: Array of shape (num_test, k) of distances; squared for
+          the 'l2' metric.
+        - top_idx: Array of shape (num_test, k) of row indices into data,
+          padded with distance inf and index -1 if data has fewer than k rows.
+        """
+        num_test = X.shape[0]
+        test_sum = squared_norms(X) if self.metric == 'l2' else None
+        top_dists = np.full((num_test, k), np.inf)
+        top_idx = np.full((num_test, k), -1, dtype=np.int64)
+
+        if self.pending.size:
+            ids = self.pending.array
+            dists = self._point_distances(
+                X, data[ids], test_sum,
+                None if data_sum is None else data_sum[ids])
+            dists, pos = smallest_k(dists, k)
+            top_dists, top_idx = merge_smallest_k(top_dists, top_idx,
+                                                  dists, ids[pos], k)
+
+        # Descend every query to its own leaf, one tree level at a time, and
+        # scan that leaf for its first candidates.
+        home = np.zeros(num_test, dtype=np.int64)
+        inner = np.flatnonzero(self.left[home] != -1)
+        while inner.size:
+            node = home[inner]
+            go_left = X[inner, self.split_dim[node]] < self.split_val[node]
+            home[inner] = np.where(go_left, self.left[node], self.right[node])
+            inner = inner[self.left[home[inner]] != -1]
+        order = np.argsort(home, kind='stable')
+        leaves, first = np.unique(home[order], return_index=True)
+        for leaf, q in zip(leaves, np.split(order, first[1:])):
+            self._scan_leaf(X, q, leaf, k, data, data_sum, test_sum,
+                            top_dists, top_idx)
+
+        stack = [(0, np.arange(num_test))]
+        while stack:
+            node, q = stack.pop()
+            # Drop the queries that cannot find anything closer in this node.
+            bound = self._box_distances(X[q], node)
+            q = q[bound < np.max(top_dists[q], axis=1)]
+            if q.size == 0:
+                continue
+
+            if self.left[node] == -1:
+                self._scan_leaf(X, q[home[q] != node], node, k, data, data_sum,
+                                test_sum, top_dists, top_idx)
+                continue
+
+            left, right = self.left[node], self.right[node]
+            go_left = X[q, self.split_dim[node]] < self.split_val[node]
+            # The far child goes on the stack first, so the child nearer to
+            # most of the queries is explored first and tightens their bounds.
+            if 2 * np.count_nonzero(go_left) >= q.size:
+                stack.extend(((right, q), (left, q)))
+            else:
+                stack.extend(((left, q), (right, q)))
+        return top_dists, top_idx
+
+    def _scan_leaf(self, X, q, node, k, data, data_sum, test_sum, top_dists,
+                   top_idx):
+        """
+        Merge the points of leaf node into the candidates top_dists[q],
+        top_idx[q] of the queries q, in place.
+        """
+        if q.size == 0:
+            return
+        ids = self.order[self.start[node]:self.end[node]]
+        dists = self._point_distances(
+            X[q], data[ids],
+            None if test_sum is None else test_sum[q],
+            None if data_sum is None else data_sum[ids])
+        dists, pos = smallest_k(dists, k)
+        top_dists[q], top_idx[q] = merge_smallest_k(
+            top_dists[q], top_idx[q], dists, ids[pos], k)
@@ -2,19 +2,181 @@ from __future__ import print_function
 
 from builtins import range
 from builtins import object
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from scipy.optimize import minimize
 from cs231n.classifiers.linear_svm import *
 from cs231n.classifiers.softmax import *
 from past.builtins import xrange
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Default amount of data read from disk at a time by block_batches.
+DEFAULT_BLOCK_BYTES = 64 * 1024**2
+
+
+def epoch_batches(X, y, batch_size):
+    """
+    Endlessly yield minibatches that sweep over the data one epoch at a time.
+
+    The data is copied once; at the start of every epoch the copy is shuffled
+    in place and then cut into consecutive slices, so every batch is a
+    zero-copy view and every training sample is seen exactly once per epoch.
+    The last batch of an epoch holds the remaining num_train % batch_size
+    samples if batch_size does not divide num_train.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) containing training data.
+    - y: A numpy array of shape (N,) containing training labels.
+    - batch_size: (integer) number of training examples per batch.
+
+    Yields tuples (X_batch, y_batch).
+    """
+    X = np.array(X, copy=True)
+    y = np.array(y, copy=True)
+    num_train = X.shape[0]
+    while True:
+        # Replaying the random state shuffles X and y with the same permutation.
+        state = np.random.get_state()
+        np.random.shuffle(X)
+        np.random.set_state(state)
+        np.random.shuffle(y)
+        for start in range(0, num_train, batch_size):
+            yield X[start:start + batch_size], y[start:start + batch_size]
+
+
+def block_batches(X, y, batch_size, block_size=None, prefetch=2):
+    """
+    Endlessly yield minibatches from data that does not fit in memory.
+
+    X and y may be numpy arrays, np.memmap arrays (e.g. from np.load with
+    mmap_mode='r') or any reader with a shape and contiguous slicing
+    X[start:stop]. The data is read in blocks of consecutive rows, so disk
+    reads stay sequential. Each epoch visits the blocks in a random order;
+    the rows of a block are shuffled in memory and cut into minibatches, so
+    every training sample is seen exactly once per epoch.
+
+    A background thread reads up to prefetch blocks ahead, overlapping disk
+    reads with the gradient computation on the current block. The thread
+    stops when the generator is closed or garbage collected.
+
+    Inputs:
+    - X: Array-like of shape (N, D) containing training data.
+    - y: Array-like of shape (N,) containing training labels.
+    - batch_size: (integer) number of training examples per batch.
+    - block_size: (integer) number of rows read at a time; rounded up to a
+      multiple of batch_size. Defaults to about DEFAULT_BLOCK_BYTES of data.
+    - prefetch: (integer) number of blocks read ahead of the current one.
+
+    Yields tuples (X_batch, y_batch).
+    """
+    num_train, dim = X.shape
+    if block_size is None:
+        row_bytes = dim * np.dtype(getattr(X, 'dtype', np.float64)).itemsize
+        block_size = max(DEFAULT_BLOCK_BYTES // row_bytes, 1)
+    block_size = -(-block_size // batch_size) * batch_size
+    starts = np.arange(0, num_train, block_size)
+    # Draw the seed here so the reader thread never touches the global state.
+    rng = np.random.RandomState(np.random.randint(2**31))
+
+    blocks = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read_blocks():
+        try:
+            while not stop.is_set():
+                for start in rng.permutation(starts):
+                    if stop.is_set():
+                        return
+                    stop_row = min(start + block_size, num_train)
+                    perm = rng.permutation(stop_row - start)
+                    put((np.asarray(X[start:stop_row])[perm],
+                         np.asarray(y[start:stop_row])[perm]))
+        except Exception as e:
+            put(e)
+
+    reader = threading.Thread(target=read_blocks)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            X_block, y_block = block
+            for start in range(0, X_block.shape[0], batch_size):
+                yield (X_block[start:start + batch_size],
+                       y_block[start:start + batch_size])
+    finally:
+        stop.set()
+
+
+def sharded_loss(loss_function, W, X, y, reg, executor, num_shards):
+    """
+    Evaluate a loss function on a minibatch split across a thread pool.
+
+    The minibatch is cut into num_shards contiguous slices and loss_function
+    runs on each of them in executor without regularization. NumPy releases
+    the GIL inside the large array operations, so the shards run in parallel.
+    The per-shard losses and gradients are averaged, weighted by shard size,
+    and the regularization 0.5 * reg * |W|^2 shared by svm_loss_vectorized
+    and softmax_loss_vectorized is added once.
+
+    Inputs:
+    - loss_function: Function (W, X, y, reg) -> (loss, dW), e.g.
+      svm_loss_fused or softmax_loss_vectorized. It is called concurrently,
+      so it must not share buffers between calls.
+    - W, X, y, reg: As for the loss function.
+    - executor: A concurrent.futures executor to run the shards in.
+    - num_shards: (integer) number of shards.
+
+    Returns a tuple of:
+    - loss as single float
+    - gradient with respect to weights W; an array of same shape as W
+    """
+    num_train = X.shape[0]
+    bounds = np.linspace(0, num_train, num_shards + 1).astype(int)
+    shards = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])
+              if stop > start]
+    futures = [executor.submit(loss_function, W, X[start:stop], y[start:stop], 0.0)
+               for start, stop in shards]
+
+    loss = 0.0
+    dW = np.zeros_like(W)
+    for (start, stop), future in zip(shards, futures):
+        shard_loss, shard_dW = future.result()
+        weight = (stop - start) / float(num_train)
+        loss += weight * shard_loss
+        dW += weight * shard_dW
+    loss += 0.5 * reg * np.sum(W * W)
+    dW += reg * W
+    return loss, dW
 
 
 class LinearClassifier(object):
 
+    # Thread-safe function (W, X, y, reg) -> (loss, dW) used on the shards of
+    # a minibatch when training with n_jobs > 1. Subclasses will override this.
+    loss_function = None
+
     def __init__(self):
         self.W = None
 
     def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
-              batch_size=200, verbose=False):
+              batch_size=200, verbose=False, sampling='random',
+              block_size=None, n_jobs=None):
         """
         Train this linear classifier using stochastic gradient descent.
 
@@ -28,6 +190,17 @@ class LinearClassifier(object):
         - num_iters: (integer) number of steps to take when optimizing
         - batch_size: (integer) number of training examples to use at each step.
         - verbose: (boolean) If true, print progress during optimization.
+        - sampling: How minibatches are drawn. 'random' samples every batch
+          independently with replacement; 'epoch' shuffles a private copy of
+          the data once per epoch and walks through it in contiguous slices
+          (see epoch_batches); 'block' reads the data in shuffled blocks
+          of consecutive rows on a background thread (see block_batches), for
+          np.memmap arrays or chunked readers that do not fit in memory.
+        - block_size: (integer) rows per block for sampling='block'.
+        - n_jobs: If greater than 1, split every minibatch across this many
+          threads (see sharded_loss); -1 uses all CPUs. This pays off for
+          large batches, where the elementwise work around the matrix
+          multiplications dominates.
 
         Outputs:
         A list containing the value of the loss function at each training iteration.
@@ -37,6 +210,17 @@ class LinearClassifier(object):
         if self.W is None:
             # lazily initialize W
             self.W = 0.001 * np.random.randn(dim, num_classes)
+            if getattr(X, 'dtype', None) == np.float32:
+                # Keep single precision data in single precision end to end.
+                self.W = self.W.astype(np.float32)
+
+        if sampling == 'epoch':
+            batches = epoch_batches(X, y, batch_size)
+        elif sampling == 'block':
+            batches = block_batches(X, y, batch_size, block_size)
+        elif sampling != 'random':
+            raise ValueError('Unrecognized sampling "%s"' % sampling)
+        executor, n_jobs = self._make_executor(n_jobs)
 
         # Run stochastic gradient descent to optimize W
         loss_history = []
@@ -57,14 +241,17 @@ class LinearClassifier(object):
             #########################################################################
             # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
-            rand_idx = np.random.choice(num_train, batch_size)
-            X_batch = X[rand_idx, :]
-            y_batch = y[rand_idx]
+            if sampling in ('epoch', 'block'):
+                X_batch, y_batch = next(batches)
+            else:
+                rand_idx = np.random.choice(num_train, batch_size)
+                X_batch = X[rand_idx, :]
+                y_batch = y[rand_idx]
 
             # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
             # evaluate loss and gradient
-            loss, grad = self.loss(X_batch, y_batch, reg)
+            loss, grad = self._loss(X_batch, y_batch, reg, executor, n_jobs)
             loss_history.append(loss)
 
             # perform parameter update
@@ -74,13 +261,162 @@ class LinearClassifier(object):
             #########################################################################
             # *****START OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
-            self.W -= learning_rate * grad
+            grad *= learning_rate
+            self.W -= grad
 
             # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
             if verbose and it % 100 == 0:
                 print('iteration %d / %d: loss %f' % (it, num_iters, loss))
 
+        if sampling == 'block':
+            batches.close()
+        if executor is not None:
+            executor.shutdown()
+
+        return loss_history
+
+    def train_sweep(self, X, y, learning_rates, regs, num_iters=100,
+                    batch_size=200, verbose=False, sampling='random',
+                    block_size=None):
+        """
+        Train one model per (learning rate, regularization) pair at the same
+        time, for hyperparameter search.
+
+        The K weight matrices are stacked into a (K, D, C) tensor and every
+        step scores one shared minibatch for all models with a single matrix
+        multiplication (see loss_batched), so the data is read once per step
+        rather than once per model. Every model takes the same steps that
+        train would take with its own hyperparameters on the same batches.
+
+        Inputs:
+        - X, y, num_iters, batch_size, sampling, block_size: As for train.
+        - learning_rates: Sequence of K learning rates.
+        - regs: Sequence of K regularization strengths, paired with
+          learning_rates.
+        - verbose: (boolean) If true, print progress during optimization.
+
+        Returns a tuple of:
+        - models: List of K classifiers of the same class as self, where
+          models[i] was trained with learning_rates[i] and regs[i].
+        - loss_history: Array of shape (num_iters, K) of training losses.
+        """
+        learning_rates = np.asarray(learning_rates, dtype=np.float64)
+        regs = np.asarray(regs, dtype=np.float64)
+        if learning_rates.shape != regs.shape or learning_rates.ndim != 1:
+            raise ValueError('learning_rates and regs must be sequences of equal length')
+        num_models = learning_rates.size
+        num_train, dim = X.shape
+        num_classes = np.max(y) + 1
+        W = 0.001 * np.random.randn(num_models, dim, num_classes)
+
+        if sampling == 'epoch':
+            batches = epoch_batches(X, y, batch_size)
+        elif sampling == 'block':
+            batches = block_batches(X, y, batch_size, block_size)
+        elif sampling != 'random':
+            raise ValueError('Unrecognized sampling "%s"' % sampling)
+
+        loss_history = np.zeros((num_iters, num_models))
+        for it in range(num_iters):
+            if sampling in ('epoch', 'block'):
+                X_batch, y_batch = next(batches)
+            else:
+                rand_idx = np.random.choice(num_train, batch_size)
+                X_batch = X[rand_idx, :]
+                y_batch = y[rand_idx]
+
+            loss, grad = self.loss_batched(W, X_batch, y_batch, regs)
+            loss_history[it] = loss
+            W -= learning_rates[:, None, None] * grad
+
+            if verbose and it % 100 == 0:
+                print('iteration %d / %d: best loss %f' % (it, num_iters, np.min(loss)))
+
+        if sampling == 'block':
+            batches.close()
+
+        models = []
+        for i in range(num_models):
+            model = self.__class__()
+            model.W = W[i].copy()
+            models.append(model)
+        return models, loss_history
+
+    def train_lbfgs(self, X, y, reg=1e-5, max_iters=100, history_size=10,
+                    tol=1e-5, verbose=False, n_jobs=None):
+        """
+        Train this linear classifier with full-batch L-BFGS.
+
+        Every iteration evaluates self.loss on all of X, i.e. one pair of large
+        matrix multiplications that a multithreaded BLAS spreads over all
+        cores (the thread count follows the usual OMP_NUM_THREADS /
+        OPENBLAS_NUM_THREADS / MKL_NUM_THREADS variables). The quasi-Newton
+        direction is built from the last history_size gradient pairs and the
+        step is chosen by a Wolfe line search (scipy's L-BFGS-B). On the
+        smooth, convex softmax loss this converges in tens of iterations
+        where SGD needs thousands of minibatch steps; the SVM hinge loss is
+        not smooth, so there the line search may stop early and report it.
+
+        Inputs:
+        - X: A numpy array of shape (N, D) containing training data.
+        - y: A numpy array of shape (N,) containing training labels.
+        - reg: (float) regularization strength.
+        - max_iters: (integer) maximum number of L-BFGS iterations.
+        - history_size: (integer) number of correction pairs kept.
+        - tol: (float) stop once the largest gradient entry falls below tol.
+        - verbose: (boolean) If true, print progress during optimization.
+        - n_jobs: As for train; every full-batch evaluation is split across
+          this many threads.
+
+        Outputs:
+        A list containing the value of the loss function after each iteration.
+        The outcome of the optimization is stored in self.lbfgs_info, a
+        dictionary with keys 'converged', 'message', 'num_iters',
+        'num_evals' and 'loss'.
+        """
+        num_train, dim = X.shape
+        num_classes = np.max(y) + 1
+        if self.W is None:
+            self.W = 0.001 * np.random.randn(dim, num_classes)
+        shape = self.W.shape
+        executor, n_jobs = self._make_executor(n_jobs)
+
+        last = {}
+        def loss_and_grad(w):
+            self.W = w.reshape(shape)
+            loss, grad = self._loss(X, y, reg, executor, n_jobs)
+            last['w'], last['loss'] = w.copy(), loss
+            # Copy the gradient: loss may return a buffer it reuses next call.
+            return loss, np.array(grad, dtype=np.float64).ravel()
+
+        loss_history = []
+        def callback(w):
+            if 'w' in last and np.array_equal(w, last['w']):
+                loss = last['loss']
+            else:
+                loss = loss_and_grad(w)[0]
+            loss_history.append(loss)
+            if verbose and len(loss_history) % 10 == 1:
+                print('iteration %d / %d: loss %f' % (len(loss_history) - 1,
+                                                      max_iters, loss))
+
+        result = minimize(loss_and_grad, self.W.astype(np.float64).ravel(),
+                          jac=True, method='L-BFGS-B', callback=callback,
+                          options={'maxiter': max_iters, 'maxcor': history_size,
+                                   'gtol': tol})
+        self.W = result.x.reshape(shape)
+        if executor is not None:
+            executor.shutdown()
+        self.lbfgs_info = {
+            'converged': bool(result.success), 'message': str(result.message),
+            'num_iters': int(result.nit), 'num_evals': int(result.nfev),
+            'loss': float(result.fun),
+        }
+        if verbose:
+            print('L-BFGS finished after %d iterations: %s' %
+                  (result.nit, result.message))
+
         return loss_history
 
     def predict(self, X):
@@ -90,13 +426,29 @@ class LinearClassifier(object):
 
         Inputs:
         - X: A numpy array of shape (N, D) containing training data; there are N
-          training samples each of dimension D.
+          training samples each of dimension D. An np.memmap is an ndarray and
+          is scored in a single pass, reading X through the mapping. Other
+          array-likes with a shape and slicing, such as chunked readers or
+          cs231n.kernel_approximation.MappedFeatures, are scored one block of
+          rows at a time; plain sequences are converted with np.asarray.
 
         Returns:
         - y_pred: Predicted labels for the data in X. y_pred is a 1-dimensional
           array of length N, and each element is an integer giving the predicted
           class.
         """
+        if not hasattr(X, 'shape'):
+            # Nested lists and other plain sequences are scored in one go.
+            X = np.asarray(X)
+        elif not isinstance(X, np.ndarray):
+            num_test, dim = X.shape
+            row_bytes = max(dim, 1) * np.dtype(getattr(X, 'dtype', np.float64)).itemsize
+            block_size = max(DEFAULT_BLOCK_BYTES // row_bytes, 1)
+            # The empty leading block gives an empty X an empty result.
+            return np.concatenate([np.zeros(0, dtype=np.intp)] +
+                                  [self.predict(np.asarray(X[start:start + block_size]))
+                                   for start in range(0, num_test, block_size)])
+
         y_pred = np.zeros(X.shape[0])
         ###########################################################################
         # TODO:                                                                   #
@@ -126,16 +478,98 @@ class LinearClassifier(object):
         """
         pass
 
+    def _make_executor(self, n_jobs):
+        """
+        Return (executor, n_jobs) for the n_jobs argument of the training
+        methods; the executor is None when the loss runs on a single thread.
+        """
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        if n_jobs is None or n_jobs <= 1:
+            return None, 1
+        if self.loss_function is None:
+            raise NotImplementedError('%s does not support n_jobs' %
+                                      self.__class__.__name__)
+        return ThreadPoolExecutor(n_jobs), n_jobs
+
+    def _loss(self, X_batch, y_batch, reg, executor, n_jobs):
+        """
+        Compute the loss with self.loss, or with sharded_loss over n_jobs
+        threads if executor is not None.
+        """
+        if executor is None:
+            return self.loss(X_batch, y_batch, reg)
+        return sharded_loss(self.loss_function, self.W, X_batch, y_batch, reg,
+                            executor, n_jobs)
+
+    def loss_batched(self, W, X_batch, y_batch, regs):
+        """
+        Compute the loss function and its derivative for K stacked models.
+        Subclasses will override this.
+
+        Inputs:
+        - W: A numpy array of shape (K, D, C) of model weights.
+        - X_batch, y_batch: As for loss.
+        - regs: A numpy array of shape (K,) of regularization strengths.
+
+        Returns: A tuple containing:
+        - array of shape (K,) of losses
+        - gradient with respect to W; an array of the same shape as W
+        """
+        raise NotImplementedError
+
 
 class LinearSVM(LinearClassifier):
-    """ A subclass that uses the Multiclass SVM loss function """
+    """
+    A subclass that uses the Multiclass SVM loss function.
+
+    The loss is evaluated with svm_loss_fused in a workspace kept across
+    calls, so the gradient returned by loss is overwritten by the next call.
+    """
+
+    loss_function = staticmethod(svm_loss_fused)
+
+    def __init__(self):
+        super(LinearSVM, self).__init__()
+        self.workspace = None
 
     def loss(self, X_batch, y_batch, reg):
-        return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
+        num_train, dim = X_batch.shape
+        num_classes = self.W.shape[1]
+        dtype = np.result_type(self.W, X_batch)
+        if (self.workspace is None or
+                not self.workspace.fits(num_train, dim, num_classes, dtype)):
+            self.workspace = SVMWorkspace(num_train, dim, num_classes, dtype)
+        return svm_loss_fused(self.W, X_batch, y_batch, reg, self.workspace)
+
+    def loss_batched(self, W, X_batch, y_batch, regs):
+        return svm_loss_batched(W, X_batch, y_batch, regs)
+
+    def train_dual(self, X, y, reg=1e-5, max_passes=20, tol=0.1,
+                   shrinking=True, seed=0, verbose=False):
+        """
+        Train this SVM by dual coordinate descent with svm_train_dual.
+
+        The solver starts from W = 0, so any current weights are replaced.
+        Inputs are as for svm_train_dual. Returns the loss on X after every
+        pass over the data; the solver outcome is stored in self.dual_info.
+        """
+        num_classes = np.max(y) + 1
+        if self.W is not None:
+            num_classes = max(num_classes, self.W.shape[1])
+        self.W, loss_history, self.dual_info = svm_train_dual(
+            X, y, reg, num_classes, max_passes=max_passes, tol=tol,
+            shrinking=shrinking, seed=seed, verbose=verbose)
+        return loss_history
 
 
 class Softmax(LinearClassifier):
     """ A subclass that uses the Softmax + Cross-entropy loss function """
 
+    loss_function = staticmethod(softmax_loss_vectorized)
+
     def loss(self, X_batch, y_batch, reg):
         return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
+
+    def loss_batched(self, W, X_batch, y_batch, regs):
+        return softmax_loss_batched(W, X_batch, y_batch, regs)
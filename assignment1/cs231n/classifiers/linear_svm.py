@@ -112,3 +112,279 @@ def svm_loss_vectorized(W, X, y, reg):
     # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
     return loss, dW
+
+
+def svm_loss_batched(W, X, y, reg):
+    """
+    Structured SVM loss function for K models sharing one minibatch.
+
+    Inputs:
+    - W: A numpy array of shape (K, D, C) stacking the weights of K models.
+    - X: A numpy array of shape (N, D) containing a minibatch of data.
+    - y: A numpy array of shape (N,) containing training labels.
+    - reg: A numpy array of shape (K,) of regularization strengths.
+
+    Returns a tuple of:
+    - loss: Array of shape (K,); loss[i] is what svm_loss_vectorized returns
+      for W[i] and reg[i].
+    - dW: Array of shape (K, D, C) of gradients with respect to W.
+    """
+    num_models, dim, num_classes = W.shape
+    num_train = X.shape[0]
+    rows = np.arange(num_train)
+    reg = np.asarray(reg, dtype=W.dtype)
+
+    # Lay the models side by side as a (D, K * C) matrix so that a single
+    # matrix multiplication reads X once for all of them.
+    W_flat = W.transpose(1, 0, 2).reshape(dim, num_models * num_classes)
+    scores = X.dot(W_flat).reshape(num_train, num_models, num_classes)
+    margins = scores - scores[rows, :, y][:, :, None] + 1
+    np.maximum(margins, 0, out=margins)
+    margins[rows, :, y] = 0
+
+    loss = np.sum(margins, axis=(0, 2)) / num_train
+    loss += 0.5 * reg * np.sum(W * W, axis=(1, 2))
+
+    binary = (margins > 0).astype(W.dtype)
+    binary[rows, :, y] = -np.sum(binary, axis=2)
+    dW = X.T.dot(binary.reshape(num_train, num_models * num_classes))
+    dW = dW.reshape(dim, num_models, num_classes).transpose(1, 0, 2)
+    dW /= num_train
+    dW += reg[:, None, None] * W
+
+    return loss, dW
+
+
+class SVMWorkspace(object):
+    """
+    Preallocated buffers for svm_loss_fused.
+
+    The buffers hold minibatches of up to capacity examples, so a training
+    loop can pass the same workspace to every step, including a shorter last
+    batch of an epoch, without allocating.
+    """
+
+    def __init__(self, capacity, dim, num_classes, dtype=np.float64):
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.margins = np.empty((capacity, num_classes), dtype=dtype)
+        self.correct = np.empty((capacity, num_classes), dtype=dtype)
+        self.row_sum = np.empty(capacity, dtype=dtype)
+        # offsets[i] + y[i] is the position of the correct class score of
+        # example i in the flattened margins.
+        self.offsets = np.arange(capacity, dtype=np.int64) * num_classes
+        self.flat_idx = np.empty(capacity, dtype=np.int64)
+        self.dW = np.empty((dim, num_classes), dtype=dtype)
+        self.reg_W = np.empty((dim, num_classes), dtype=dtype)
+
+    def fits(self, num_train, dim, num_classes, dtype):
+        """ Whether the buffers can serve a problem of the given size. """
+        return (num_train <= self.capacity and
+                self.dW.shape == (dim, num_classes) and self.dtype == dtype)
+
+
+def svm_loss_fused(W, X, y, reg, workspace=None):
+    """
+    Structured SVM loss function, fused implementation that works inside
+    preallocated buffers.
+
+    Computes the same loss and gradient as svm_loss_vectorized, but every
+    intermediate array lives in workspace and is updated in place, so
+    repeated calls with the same workspace allocate no (N, C) or (D, C)
+    arrays. The computation runs in the precision of W and X; pass float32
+    arrays for single precision end to end.
+
+    Inputs:
+    - W, X, y, reg: As for svm_loss_vectorized. W and X should share their
+      dtype; otherwise the lower precision one is converted on every call.
+    - workspace: An SVMWorkspace to reuse. If None or unable to hold the
+      problem, a new one is allocated for this call.
+
+    Returns a tuple of:
+    - loss as single float
+    - gradient with respect to weights W. This is workspace.dW, which the
+      next call with the same workspace overwrites.
+    """
+    num_train, dim = X.shape
+    num_classes = W.shape[1]
+    dtype = np.result_type(W, X)
+    if W.dtype != dtype:
+        W = W.astype(dtype)
+    if X.dtype != dtype:
+        X = X.astype(dtype)
+    if workspace is None or not workspace.fits(num_train, dim, num_classes, dtype):
+        workspace = SVMWorkspace(num_train, dim, num_classes, dtype)
+
+    margins = workspace.margins[:num_train]
+    flat_margins = margins.reshape(-1)
+    row_sum = workspace.row_sum[:num_train]
+    flat_idx = workspace.flat_idx[:num_train]
+    np.add(workspace.offsets[:num_train], y, out=flat_idx)
+
+    # margins = max(0, scores - correct_scores + 1), with zeros at the correct
+    # classes. The correct scores are spread over a full (N, C) buffer first:
+    # a broadcasting subtraction would make numpy allocate a staging buffer.
+    correct = workspace.correct[:num_train]
+    np.dot(X, W, out=margins)
+    np.take(flat_margins, flat_idx, out=row_sum)
+    np.copyto(correct, row_sum[:, None])
+    margins -= correct
+    margins += 1
+    np.maximum(margins, 0, out=margins)
+    flat_margins[flat_idx] = 0
+    loss = np.sum(margins) / num_train + 0.5 * reg * np.vdot(W, W)
+
+    # Margins are non-negative, so their sign is the 0/1 indicator of the
+    # active ones; the correct class gets minus the number of active margins.
+    np.sign(margins, out=margins)
+    np.sum(margins, axis=1, out=row_sum)
+    np.negative(row_sum, out=row_sum)
+    flat_margins[flat_idx] = row_sum
+    dW = workspace.dW
+    np.dot(X.T, margins, out=dW)
+    dW /= num_train
+    np.multiply(W, reg, out=workspace.reg_W)
+    dW += workspace.reg_W
+
+    return loss, dW
+
+
+def _solve_dual_block(G, alpha, upper, sq_norm):
+    """
+    Exactly minimize the dual objective over the multipliers of one example.
+
+    Moving the multipliers of example i by delta changes its margins by
+    sq_norm * (sum(delta) + delta), so with a = -G / sq_norm the optimum is
+    alpha_new = clip(alpha + a - S, 0, upper), where S = sum(alpha_new - alpha)
+    is the root of an increasing piecewise linear function. The root is found
+    from its breakpoints.
+
+    Inputs:
+    - G: Array of shape (C,) of dual gradients, margin - 1, for each class.
+    - alpha: Array of shape (C,) of current multipliers.
+    - upper: Array of shape (C,) of upper bounds; 0 for the correct class.
+    - sq_norm: (float) squared norm of the example.
+
+    Returns the new multipliers as an array of shape (C,).
+    """
+    target = alpha - G / sq_norm
+    breaks = np.sort(np.concatenate([target - upper, target]))
+    moved = np.clip(target[None, :] - breaks[:, None], 0, upper) - alpha
+    h = breaks - np.sum(moved, axis=1)
+    idx = np.searchsorted(h, 0)
+    if idx == 0:
+        shift = np.sum(upper - alpha)
+    elif idx == len(h):
+        shift = -np.sum(alpha)
+    else:
+        b0, b1, h0, h1 = breaks[idx - 1], breaks[idx], h[idx - 1], h[idx]
+        shift = b0 - h0 * (b1 - b0) / (h1 - h0) if h1 > h0 else b0
+    return np.clip(target - shift, 0, upper)
+
+
+def svm_train_dual(X, y, reg, num_classes=None, max_passes=20, tol=0.1,
+                   shrinking=True, seed=0, verbose=False):
+    """
+    Train a structured SVM by coordinate descent on its dual problem.
+
+    Minimizing the loss of svm_loss_vectorized is equivalent to the
+    Weston-Watkins SVM problem 1/2 |W|^2 + C sum_ij max(0, margin_ij) with
+    C = 1 / (reg * N). Its dual has one multiplier alpha_ij in [0, C] for every
+    example i and wrong class j, and W = sum_ij alpha_ij X[i] (e_{y_i} - e_j).
+    Each step visits one example, solves for all of its multipliers exactly
+    and applies the change to W as a rank one update, so a pass costs about
+    as much as one epoch of SGD but needs no learning rate.
+
+    As in liblinear, examples whose multipliers all sit at a bound with the
+    gradient pointing outwards are shrunk out of the active set; once the
+    active set has converged, all examples are checked once more.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) containing training data.
+    - y: A numpy array of shape (N,) containing training labels.
+    - reg: (float) regularization strength, as in svm_loss_vectorized.
+    - num_classes: (integer) number of classes; defaults to max(y) + 1.
+    - max_passes: (integer) maximum number of passes over the active set.
+    - tol: (float) stop once the projected gradients span less than tol.
+    - shrinking: (boolean) whether to shrink inactive examples.
+    - seed: (integer) seed for the order in which examples are visited.
+    - verbose: (boolean) If true, print progress after every pass.
+
+    Returns a tuple of:
+    - W: A numpy array of shape (D, C) of trained weights.
+    - loss_history: The svm_loss_vectorized loss on X after every pass.
+    - info: Dictionary with 'converged', 'num_passes' and 'num_active', the
+      size of the active set in the last pass.
+    """
+    if reg <= 0:
+        raise ValueError('The dual solver needs reg > 0, got %r' % (reg,))
+    num_train, dim = X.shape
+    if num_classes is None:
+        num_classes = np.max(y) + 1
+    rng = np.random.RandomState(seed)
+    C = 1.0 / (reg * num_train)
+
+    W = np.zeros((dim, num_classes))
+    alpha = np.zeros((num_train, num_classes))
+    upper = np.full((num_train, num_classes), C)
+    upper[np.arange(num_train), y] = 0
+    sq_norms = np.einsum('ij,ij->i', X, X, dtype=np.float64)
+
+    active = np.flatnonzero(sq_norms > 0)
+    pg_max_old, pg_min_old = np.inf, -np.inf
+    loss_history = []
+    converged = False
+    for it in range(max_passes):
+        pg_max, pg_min = -np.inf, np.inf
+        keep = np.ones(len(active), dtype=bool)
+        order = rng.permutation(len(active))
+        for pos in order:
+            i = active[pos]
+            x = X[i]
+            scores = x.dot(W)
+            G = scores[y[i]] - scores - 1
+            a_i, u_i = alpha[i], upper[i]
+
+            at_lower, at_upper = a_i == 0, a_i == u_i
+            free = u_i > 0
+            PG = np.where(at_lower, np.minimum(G, 0),
+                          np.where(at_upper, np.maximum(G, 0), G))
+            PG[~free] = 0
+            if shrinking:
+                out = ((at_lower & (G > pg_max_old)) |
+                       (at_upper & (G < pg_min_old)))
+                if np.all(out | ~free):
+                    keep[pos] = False
+                    continue
+            pg_max = max(pg_max, np.max(PG))
+            pg_min = min(pg_min, np.min(PG))
+            if np.max(np.abs(PG)) < 1e-12:
+                continue
+
+            new_alpha = _solve_dual_block(G, a_i, u_i, sq_norms[i])
+            delta = new_alpha - a_i
+            delta[y[i]] = -np.sum(delta)
+            alpha[i] = new_alpha
+            W -= np.outer(x, delta)
+
+        active = active[keep]
+        loss_history.append(svm_loss_vectorized(W, X, y, reg)[0])
+        if verbose:
+            print('pass %d / %d: loss %f, active %d, gap %f' %
+                  (it + 1, max_passes, loss_history[-1], len(keep),
+                   pg_max - pg_min))
+
+        if pg_max - pg_min <= tol:
+            if len(active) == num_train or not shrinking:
+                converged = True
+                break
+            # The shrunk problem has converged; check every example again.
+            active = np.flatnonzero(sq_norms > 0)
+            pg_max_old, pg_min_old = np.inf, -np.inf
+            continue
+        pg_max_old = pg_max if pg_max > 0 else np.inf
+        pg_min_old = pg_min if pg_min < 0 else -np.inf
+
+    info = {'converged': converged, 'num_passes': len(loss_history),
+            'num_active': len(keep)}
+    return W, loss_history, info
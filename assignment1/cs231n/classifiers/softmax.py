@@ -78,8 +78,11 @@ def softmax_loss_vectorized(W, X, y, reg):
 
     num_train = X.shape[0]
     scores = np.dot(X, W)
+    # Shift the scores of every row for numeric stability, then normalize
+    # every row into a distribution over classes.
+    scores -= np.max(scores, axis=1, keepdims=True)
     exp_scores = np.exp(scores)
-    prob_scores = exp_scores / np.sum(exp_scores)
+    prob_scores = exp_scores / np.sum(exp_scores, axis=1, keepdims=True)
     correct_log_probs = -np.log(prob_scores[range(num_train), y])
     loss = np.sum(correct_log_probs) # loss is the sum of correct_log_probs
     loss /= num_train # avg loss
@@ -95,3 +98,44 @@ def softmax_loss_vectorized(W, X, y, reg):
     # *****END OF YOUR CODE (DO NOT DELETE/MODIFY THIS LINE)*****
 
     return loss, dW
+
+
+def softmax_loss_batched(W, X, y, reg):
+    """
+    Softmax loss function for K models sharing one minibatch.
+
+    Inputs:
+    - W: A numpy array of shape (K, D, C) stacking the weights of K models.
+    - X: A numpy array of shape (N, D) containing a minibatch of data.
+    - y: A numpy array of shape (N,) containing training labels.
+    - reg: A numpy array of shape (K,) of regularization strengths.
+
+    Returns a tuple of:
+    - loss: Array of shape (K,); loss[i] is what softmax_loss_vectorized
+      returns for W[i] and reg[i].
+    - dW: Array of shape (K, D, C) of gradients with respect to W.
+    """
+    num_models, dim, num_classes = W.shape
+    num_train = X.shape[0]
+    rows = np.arange(num_train)
+    reg = np.asarray(reg, dtype=W.dtype)
+
+    # Lay the models side by side as a (D, K * C) matrix so that a single
+    # matrix multiplication reads X once for all of them.
+    W_flat = W.transpose(1, 0, 2).reshape(dim, num_models * num_classes)
+    scores = X.dot(W_flat).reshape(num_train, num_models, num_classes)
+    scores -= np.max(scores, axis=2, keepdims=True)
+    prob_scores = np.exp(scores, out=scores)
+    prob_scores /= np.sum(prob_scores, axis=2, keepdims=True)
+
+    loss = -np.sum(np.log(prob_scores[rows, :, y]), axis=0) / num_train
+    loss += 0.5 * reg * np.sum(W * W, axis=(1, 2))
+
+    dscores = prob_scores
+    dscores[rows, :, y] -= 1
+    dW = X.T.dot(dscores.reshape(num_train, num_models * num_classes))
+    dW = dW.reshape(dim, num_models, num_classes).transpose(1, 0, 2)
+    dW /= num_train
+    dW += reg[:, None, None] * W
+
+    return loss, dW
@@ -3,7 +3,9 @@ from __future__ import print_function
 from builtins import range
 from six.moves import cPickle as pickle
 import numpy as np
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 # from scipy.misc import imread
 from imageio import imread
 import platform
@@ -42,6 +44,125 @@ def load_CIFAR10(ROOT):
     return Xtr, Ytr, Xte, Yte
 
 
+# Layout version of the .npy cache written by convert_CIFAR10; bump it when
+# the layout changes so old caches are rebuilt.
+CIFAR10_CACHE_VERSION = 1
+CIFAR10_BATCHES = ['data_batch_%d' % b for b in range(1, 6)] + ['test_batch']
+
+
+def _load_CIFAR_batch_uint8(filename):
+    """ load single batch of cifar as uint8 images and int64 labels """
+    with open(filename, 'rb') as f:
+        datadict = load_pickle(f)
+        X = datadict['data'].reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1)
+        Y = np.array(datadict['labels'], dtype=np.int64)
+        return np.ascontiguousarray(X, dtype=np.uint8), Y
+
+
+def _CIFAR10_sources(ROOT):
+    """ (size, mtime) of every batch file, to detect a stale cache """
+    sources = {}
+    for name in CIFAR10_BATCHES:
+        stat = os.stat(os.path.join(ROOT, name))
+        sources[name] = [stat.st_size, int(stat.st_mtime)]
+    return sources
+
+
+def convert_CIFAR10(ROOT, cache_dir=None, max_workers=None):
+    """
+    Convert the pickled CIFAR-10 batches in ROOT into a compact .npy cache.
+
+    The six batch files are unpickled in parallel processes and written as
+    X_train.npy and X_test.npy (uint8, N x 32 x 32 x 3) and y_train.npy and
+    y_test.npy (int64), plus a meta.json header recording the layout
+    version, the shapes and the size and modification time of the source
+    files. meta.json is written last, so an interrupted conversion is
+    simply redone by the next load.
+
+    Inputs:
+    - ROOT: Directory of the cifar-10-batches-py files.
+    - cache_dir: Output directory; defaults to ROOT/npy.
+    - max_workers: Number of conversion processes; defaults to one per batch
+      file, up to the number of CPUs.
+
+    Returns the metadata dictionary that was written to meta.json.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(ROOT, 'npy')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    if max_workers is None:
+        max_workers = min(len(CIFAR10_BATCHES), os.cpu_count() or 1)
+
+    files = [os.path.join(ROOT, name) for name in CIFAR10_BATCHES]
+    with ProcessPoolExecutor(max_workers) as executor:
+        batches = list(executor.map(_load_CIFAR_batch_uint8, files))
+
+    arrays = {
+        'X_train': np.concatenate([X for X, _ in batches[:-1]]),
+        'y_train': np.concatenate([Y for _, Y in batches[:-1]]),
+        'X_test': batches[-1][0],
+        'y_test': batches[-1][1],
+    }
+    for name, arr in arrays.items():
+        np.save(os.path.join(cache_dir, name + '.npy'), arr)
+
+    meta = {
+        'version': CIFAR10_CACHE_VERSION,
+        'arrays': dict((name, {'shape': list(arr.shape), 'dtype': arr.dtype.str})
+                       for name, arr in arrays.items()),
+        'sources': _CIFAR10_sources(ROOT),
+    }
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    os.replace(meta_path + '.tmp', meta_path)
+    return meta
+
+
+def load_CIFAR10_cached(ROOT, cache_dir=None, max_workers=None):
+    """
+    Load CIFAR-10 as read-only uint8 memory maps from the .npy cache.
+
+    The first call converts the pickled batches with convert_CIFAR10; later
+    calls only map the cached files, which takes milliseconds and reads
+    pixels from disk as they are used. The cache is rebuilt when its layout
+    version is outdated or the batch files in ROOT have changed; if the batch
+    files are gone, an existing cache is used as is.
+
+    Unlike load_CIFAR10 the images stay uint8; convert them with
+    X.astype(np.float64) (or float32) where floating point data is needed.
+
+    Inputs:
+    - ROOT, cache_dir, max_workers: As for convert_CIFAR10.
+
+    Returns a tuple of:
+    - X_train: np.memmap of shape (50000, 32, 32, 3) and dtype uint8.
+    - y_train: np.memmap of shape (50000,) and dtype int64.
+    - X_test: np.memmap of shape (10000, 32, 32, 3) and dtype uint8.
+    - y_test: np.memmap of shape (10000,) and dtype int64.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(ROOT, 'npy')
+    meta_path = os.path.join(cache_dir, 'meta.json')
+
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('version') != CIFAR10_CACHE_VERSION:
+            meta = None
+        elif all(os.path.exists(os.path.join(ROOT, name))
+                 for name in CIFAR10_BATCHES):
+            if meta['sources'] != _CIFAR10_sources(ROOT):
+                meta = None
+    if meta is None:
+        convert_CIFAR10(ROOT, cache_dir, max_workers)
+
+    return tuple(np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+                 for name in ('X_train', 'y_train', 'X_test', 'y_test'))
+
+
 def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
                      subtract_mean=True):
     """
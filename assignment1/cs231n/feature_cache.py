@@ -0,0 +1,257 @@
+"""
+Content-addressed on-disk cache for extract_features.
+
+Features are stored as .npy files named by a hash of the image data and of
+the feature functions (their names, default arguments and bound
+parameters such as nbin), so re-running an experiment on the same images
+memory-maps the stored features instead of recomputing them:
+
+    cache = FeatureCache('~/.cache/cs231n_features', max_bytes=2 * 1024**3)
+    fns = [hog_feature, functools.partial(color_histogram_hsv, nbin=10)]
+    X_train_feats = cache.extract_features(X_train, fns)
+
+Lambdas are hashed by their code together with the values they close over
+and the scalar and array globals they read, so the notebook idiom
+lambda img: color_histogram_hsv(img, nbin=num_color_bins) gets a new key
+when num_color_bins changes. functools.partial is the more explicit choice.
+Arrays are hashed by content, and values that cannot be described
+deterministically raise a ValueError rather than produce an unstable key.
+"""
+from builtins import object
+import functools
+import hashlib
+import os
+import types
+
+import numpy as np
+
+from cs231n.features import extract_features_to_memmap
+
+# Bump to invalidate existing cache entries when feature code changes.
+CACHE_VERSION = 2
+
+_SCALAR_TYPES = (bool, int, float, complex, str, bytes, type(None),
+                 type(Ellipsis), np.generic)
+
+
+def hash_array(arr, block_size=1000):
+    """
+    SHA-1 of the shape, dtype and contents of an array, read block_size rows
+    at a time so that memory-mapped arrays are hashed with constant memory.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((arr.shape, np.dtype(arr.dtype).str)).encode())
+    for start in range(0, arr.shape[0], block_size):
+        digest.update(np.ascontiguousarray(arr[start:start + block_size]).data)
+    return digest.hexdigest()
+
+
+def describe_value(value, _seen=()):
+    """
+    Deterministic string describing a value a feature function depends on:
+    an argument, default, closed-over variable, global or constant.
+
+    Arrays are described by hash_array and code objects by their bytecode,
+    names and constants, never by repr, which abbreviates large arrays and
+    includes memory addresses. Raises ValueError for values that have no
+    deterministic description.
+    """
+    if isinstance(value, np.ndarray):
+        return 'array(%s)' % hash_array(np.atleast_1d(value))
+    if isinstance(value, _SCALAR_TYPES):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        return '%s(%s)' % (type(value).__name__,
+                           ', '.join(describe_value(v, _seen) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return '%s(%s)' % (type(value).__name__,
+                           ', '.join(sorted(describe_value(v, _seen) for v in value)))
+    if isinstance(value, dict):
+        return 'dict(%s)' % ', '.join(sorted(
+            '%s: %s' % (describe_value(k, _seen), describe_value(v, _seen))
+            for k, v in value.items()))
+    if isinstance(value, types.CodeType):
+        return _describe_code(value, _seen)
+    if isinstance(value, (functools.partial, types.FunctionType)):
+        return describe_feature_fn(value, _seen)
+    if isinstance(value, (types.BuiltinFunctionType, np.ufunc, type)):
+        return '%s.%s' % (getattr(value, '__module__', None),
+                          getattr(value, '__qualname__', value.__name__))
+    if isinstance(value, types.ModuleType):
+        return 'module(%s)' % value.__name__
+    raise ValueError('Cannot hash a %s deterministically for the feature cache; '
+                     'bind arrays or scalars with functools.partial instead' %
+                     type(value).__name__)
+
+
+def _describe_code(code, _seen=()):
+    """ Bytecode, names and constants of a code object, recursively. """
+    return 'code(%s, %r, %s)' % (hashlib.sha1(code.co_code).hexdigest(),
+                                 code.co_names,
+                                 describe_value(code.co_consts, _seen))
+
+
+def _global_names(code):
+    """ Global names read by a code object and the code nested in it. """
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.extend(_global_names(const))
+    return names
+
+
+def describe_feature_fn(fn, _seen=()):
+    """
+    Deterministic string describing a feature function and its parameters,
+    used as part of the cache key.
+    """
+    if isinstance(fn, functools.partial):
+        return 'partial(%s, %s, %s)' % (describe_feature_fn(fn.func, _seen),
+                                        describe_value(fn.args, _seen),
+                                        describe_value(fn.keywords or {}, _seen))
+    name = '%s.%s' % (getattr(fn, '__module__', None),
+                      getattr(fn, '__qualname__', repr(fn)))
+    code = getattr(fn, '__code__', None)
+    if code is None or fn in _seen:
+        # Recursive references are described by name only.
+        return name
+    _seen = _seen + (fn,)
+    parts = [name, _describe_code(code, _seen),
+             describe_value(fn.__defaults__, _seen),
+             describe_value(fn.__kwdefaults__ or {}, _seen)]
+    if fn.__closure__:
+        cells = []
+        for cell in fn.__closure__:
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:
+                # An empty cell, e.g. a variable assigned after the closure.
+                cells.append(None)
+        parts.append(describe_value(cells, _seen))
+    fn_globals = getattr(fn, '__globals__', {})
+    for global_name in sorted(set(_global_names(code))):
+        if global_name not in fn_globals:
+            continue
+        value = fn_globals[global_name]
+        if isinstance(value, (types.ModuleType, type)):
+            continue
+        if callable(value) and not isinstance(value, np.ndarray):
+            # Global functions are described by name; their code belongs to
+            # a module, whose changes CACHE_VERSION covers.
+            parts.append('%s=%s.%s' % (global_name,
+                                       getattr(value, '__module__', None),
+                                       getattr(value, '__qualname__', None)))
+        else:
+            parts.append('%s=%s' % (global_name, describe_value(value, _seen)))
+    return '|'.join(parts)
+
+
+class FeatureCache(object):
+    """
+    Directory of cached feature matrices with size-bounded LRU eviction.
+
+    Every entry is a single <key>.npy file. Its modification time records
+    its last use, and once the directory grows past max_bytes the least
+    recently used entries are deleted.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        """
+        Inputs:
+        - directory: Cache directory; created if missing.
+        - max_bytes: Upper bound on the total size of the cached files, or
+          None for no bound.
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, imgs, feature_fns, dtype=np.float32):
+        """ Cache key for the features of imgs under feature_fns. """
+        digest = hashlib.sha1()
+        digest.update(repr((CACHE_VERSION, np.dtype(dtype).str)).encode())
+        digest.update(hash_array(imgs).encode())
+        for fn in feature_fns:
+            digest.update(describe_feature_fn(fn).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def extract_features(self, imgs, feature_fns, dtype=np.float32,
+                         block_size=1000, n_jobs=None, verbose=False):
+        """
+        Return the features of extract_features(imgs, feature_fns), cast to
+        dtype, from the cache if present and computed and stored otherwise.
+
+        Inputs:
+        - imgs, feature_fns, block_size, n_jobs, verbose: As for
+          extract_features_to_memmap, which computes missing entries.
+        - dtype: dtype of the stored features.
+
+        Returns:
+        A read-only np.memmap of shape (N, F_1 + ... + F_k).
+        """
+        key = self.key(imgs, feature_fns, dtype)
+        path = self.path(key)
+        if os.path.exists(path):
+            if verbose:
+                print('Loading cached features from %s' % path)
+            os.utime(path, None)
+            return np.load(path, mmap_mode='r')
+
+        # Write under a temporary name so an interrupted run never leaves a
+        # truncated entry behind.
+        tmp_path = os.path.join(self.directory, '%s.%d.tmp.npy' % (key, os.getpid()))
+        try:
+            features = extract_features_to_memmap(imgs, feature_fns, tmp_path,
+                                                  block_size, dtype, n_jobs,
+                                                  verbose)
+            del features
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    def entries(self):
+        """
+        List the cached entries as (mtime, size, path) tuples, oldest first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy') or name.endswith('.tmp.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        """ Total size in bytes of the cached entries. """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Delete least recently used entries until the cache fits in max_bytes.
+        The entry at path keep, normally the one just written, is never
+        deleted, even if it alone exceeds the bound.
+        """
+        if self.max_bytes is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        """ Delete every cached entry. """
+        for _, _, path in self.entries():
+            os.remove(path)
@@ -0,0 +1,229 @@
+"""
+Approximate RBF kernel feature maps for the linear classifiers.
+
+An RBF kernel SVM on CIFAR-10 needs the full N x N kernel matrix, which does
+not scale to the 50k training images. The feature maps here instead produce
+an explicit n_components dimensional embedding whose dot products
+approximate the kernel exp(-gamma |x - y|^2), so a LinearSVM or Softmax
+trained on the embedding behaves like a kernel machine:
+
+- RBFSampler: random Fourier features (Rahimi and Recht).
+- Nystroem: the Nystroem method on a random subset of training points.
+
+Both transform data in blocks of rows, and MappedFeatures wraps a dataset
+in a lazy view whose rows are mapped on access, so the expanded feature
+matrix never has to be held in memory:
+
+    feature_map = RBFSampler(n_components=4000).fit(X_train)
+    F_train = MappedFeatures(X_train, feature_map)
+    svm = LinearSVM()
+    svm.train(F_train, y_train, sampling='block')
+    y_pred = svm.predict(MappedFeatures(X_val, feature_map))
+"""
+from builtins import range
+from builtins import object
+import numpy as np
+
+from cs231n.classifiers.knn_index import squared_distances, squared_norms
+
+
+def _default_gamma(X, num_samples=1000, seed=0):
+    """
+    The 'scale' heuristic 1 / (D * var(X)), estimated on a sample of rows so
+    that memory-mapped data is read only partially.
+    """
+    num_train, dim = X.shape
+    rng = np.random.RandomState(seed)
+    idx = np.sort(rng.choice(num_train, min(num_samples, num_train), replace=False))
+    return 1.0 / (dim * np.var(np.asarray(X[idx], dtype=np.float64)))
+
+
+class RBFSampler(object):
+    """
+    Random Fourier features: phi(x) = sqrt(2 / n) cos(x W + b) with
+    W ~ N(0, 2 gamma) and b ~ U(0, 2 pi), so that E[phi(x).phi(y)] equals
+    exp(-gamma |x - y|^2).
+    """
+
+    def __init__(self, gamma=None, n_components=1000, seed=0, dtype=np.float32):
+        """
+        Inputs:
+        - gamma: (float) kernel width; if None, 1 / (D * var(X)) on fit.
+        - n_components: (integer) dimension of the feature map.
+        - seed: (integer) seed for the random projection.
+        - dtype: dtype of the projection and of the mapped features.
+        """
+        self.gamma = gamma
+        self.n_components = n_components
+        self.seed = seed
+        self.dtype = np.dtype(dtype)
+        self.W = None
+        self.b = None
+
+    def fit(self, X):
+        """
+        Draw the random projection for data like X, of shape (N, D). Only
+        the data dimension is used, plus a sample of rows when gamma is None.
+
+        Returns self.
+        """
+        dim = X.shape[1]
+        gamma = self.gamma if self.gamma is not None else _default_gamma(X)
+        rng = np.random.RandomState(self.seed)
+        self.W = (np.sqrt(2 * gamma) * rng.randn(dim, self.n_components)).astype(self.dtype)
+        self.b = rng.uniform(0, 2 * np.pi, self.n_components).astype(self.dtype)
+        self.gamma_ = gamma
+        return self
+
+    def transform_block(self, X):
+        """ Map a block of rows held in memory; returns (N, n_components). """
+        features = np.dot(np.asarray(X, dtype=self.dtype), self.W)
+        features += self.b
+        np.cos(features, out=features)
+        features *= np.sqrt(2.0 / self.n_components)
+        return features
+
+    def transform(self, X, block_size=1024):
+        """
+        Map the rows of X, of shape (N, D), block_size rows at a time.
+
+        Returns an array of shape (N, n_components).
+        """
+        return _transform_blocks(self, X, block_size)
+
+
+class Nystroem(object):
+    """
+    Nystroem kernel approximation: phi(x) = k(x, B) K_BB^{-1/2} for a basis B
+    of n_components training points, so that phi(x).phi(y) is the kernel
+    projected onto the span of the basis.
+    """
+
+    def __init__(self, gamma=None, n_components=1000, seed=0, dtype=np.float32):
+        """
+        Inputs:
+        - gamma: (float) kernel width; if None, 1 / (D * var(X)) on fit.
+        - n_components: (integer) number of basis points; dimension of the
+          feature map.
+        - seed: (integer) seed for choosing the basis.
+        - dtype: dtype of the mapped features.
+        """
+        self.gamma = gamma
+        self.n_components = n_components
+        self.seed = seed
+        self.dtype = np.dtype(dtype)
+        self.basis = None
+        self.normalization = None
+
+    def fit(self, X):
+        """
+        Choose the basis among the rows of X, of shape (N, D), and compute
+        K_BB^{-1/2}. The basis rows are read in increasing order, so
+        memory-mapped data is read sequentially.
+
+        Returns self.
+        """
+        num_train = X.shape[0]
+        if self.n_components > num_train:
+            raise ValueError('n_components=%d exceeds the %d training points' %
+                             (self.n_components, num_train))
+        self.gamma_ = self.gamma if self.gamma is not None else _default_gamma(X)
+        rng = np.random.RandomState(self.seed)
+        idx = np.sort(rng.choice(num_train, self.n_components, replace=False))
+        self.basis = np.asarray(X[idx], dtype=np.float64)
+        self.basis_sum = squared_norms(self.basis)
+
+        kernel = self._kernel(self.basis)
+        eigvals, eigvecs = np.linalg.eigh(kernel)
+        # Drop the numerically zero directions of the basis kernel.
+        eigvals = np.maximum(eigvals, 1e-12)
+        normalization = np.dot(eigvecs / np.sqrt(eigvals), eigvecs.T)
+        self.normalization = normalization.astype(self.dtype)
+        return self
+
+    def _kernel(self, X):
+        dists = squared_distances(np.asarray(X, dtype=np.float64), self.basis,
+                                  Y_sum=self.basis_sum)
+        np.maximum(dists, 0, out=dists)
+        dists *= -self.gamma_
+        return np.exp(dists, out=dists)
+
+    def transform_block(self, X):
+        """ Map a block of rows held in memory; returns (N, n_components). """
+        return np.dot(self._kernel(X).astype(self.dtype), self.normalization)
+
+    def transform(self, X, block_size=1024):
+        """
+        Map the rows of X, of shape (N, D), block_size rows at a time.
+
+        Returns an array of shape (N, n_components).
+        """
+        return _transform_blocks(self, X, block_size)
+
+
+def _transform_blocks(feature_map, X, block_size):
+    """
+    Apply feature_map.transform_block to X block_size rows at a time, writing
+    into one preallocated output so only a block of temporaries is live.
+    """
+    num_rows = X.shape[0]
+    out = np.empty((num_rows, feature_map.n_components), dtype=feature_map.dtype)
+    for start in range(0, num_rows, block_size):
+        stop = min(start + block_size, num_rows)
+        out[start:stop] = feature_map.transform_block(X[start:stop])
+    return out
+
+
+class MappedFeatures(object):
+    """
+    Lazy view of a dataset under a fitted feature map.
+
+    Rows are mapped when they are accessed, so a view over a large or
+    memory-mapped X costs no memory until it is indexed. The view supports
+    what the linear classifiers need from training data: shape, dtype,
+    slicing X[start:stop] (sampling='block' in LinearClassifier.train and
+    blockwise LinearClassifier.predict) and row indexing X[idx, :]
+    (sampling='random').
+    """
+
+    def __init__(self, X, feature_map, bias=True):
+        """
+        Inputs:
+        - X: Array-like of shape (N, D) with slicing, e.g. an np.memmap.
+        - feature_map: A fitted RBFSampler or Nystroem.
+        - bias: (boolean) If true, append a constant 1 feature, the bias
+          trick used with the linear classifiers.
+        """
+        self.X = X
+        self.feature_map = feature_map
+        self.bias = bias
+        self.dtype = feature_map.dtype
+        self.shape = (X.shape[0], feature_map.n_components + int(bias))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key
+            if cols != slice(None):
+                raise IndexError('MappedFeatures only supports indexing rows')
+        else:
+            rows = key
+        if np.isscalar(rows):
+            return self[np.array([rows])][0]
+        if not isinstance(rows, slice):
+            rows = np.asarray(rows)
+        features = self.feature_map.transform_block(self.X[rows])
+        if self.bias:
+            features = np.hstack([features, np.ones((features.shape[0], 1),
+                                                    dtype=features.dtype)])
+        return features
+
+    def materialize(self, block_size=1024):
+        """ Map every row, block_size rows at a time, into one array. """
+        out = np.empty(self.shape, dtype=self.dtype)
+        for start in range(0, self.shape[0], block_size):
+            block = self[start:start + block_size]
+            out[start:start + block.shape[0]] = block
+        return out